@@ -74,37 +74,15 @@ async function fetchGitHubUser(token: string) {
 
     console.log("GitHub user data:", data);
 
-    // First, get all users
-    const usersResponse = await fetch(`${BASE_URL}/v1/users/`, { method: 'GET' });
-    const users = await usersResponse.json();
-    console.log("users:", JSON.stringify(users, null, 2));
-    const userList = users.ranking.map((user: { name: string; Email: string }) => ({
-      name: user.name,
-      email: user.Email 
-    }));
-    
-    console.log("User List:", userList);
-    let userExists = false;
-    // Check if user already exists
-    for (const user of userList) {
-      if(user.name == data.name && user.email == data.email){
-        userExists =true;
-      }
-    }
-    
-    if (userExists) {
-      console.log("User already exists, skipping creation.");
-    } else {
-      // Only add user if not found
-      const addUserResponse = await fetch(`${BASE_URL}/v1/users/`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ name: data.name, email: data.email }),
-      });
+    // Create the user if the email is new, otherwise just refresh the name (idempotent upsert)
+    const upsertResponse = await fetch(`${BASE_URL}/v1/users/by-email/${encodeURIComponent(data.email)}`, {
+      method: 'PUT',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ name: data.name }),
+    });
 
-      const responseJson = await addUserResponse.json();
-      console.log("Server response:", responseJson);
-    }
+    const responseJson = await upsertResponse.json();
+    console.log("Server response:", responseJson);
 
     // Navigate to profile page
     setTimeout(() => {
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select, update, inspect, text, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import invalidation
+from database import AsyncSessionLocal
+from models import User
+
+# As chaves de API não são guardadas em claro: a base de dados só tem o SHA-256 (64 caracteres hex)
+# na coluna users.api_key_hash, com índice único. Validar uma chave é calcular o hash e procurá-lo.
+#
+# Como os outros serviços validam a chave em todos os pedidos, as validações bem sucedidas ficam numa
+# cache LRU com TTL (hash -> user_id). Quando uma chave é substituída ou o utilizador é removido a entrada
+# é invalidada depois do commit, neste processo e nos outros workers (invalidation.py); sem o canal de
+# invalidação, noutros processos a entrada antiga expira ao fim do TTL.
+#
+# Para migrar uma base de dados com chaves em claro: python api_keys.py migrate (também corre em python migrate.py create)
+
+API_KEY_CACHE_TTL = float(os.getenv("API_KEY_CACHE_TTL", "60"))
+API_KEY_CACHE_SIZE = int(os.getenv("API_KEY_CACHE_SIZE", "10000"))
+
+
+def hash_api_key(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class ApiKeyCache:
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # hash -> (user_id, expira_em)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key_hash: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key_hash)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key_hash]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key_hash)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key_hash: str, user_id: int):
+        with self._lock:
+            self._entries[key_hash] = (user_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key_hash)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key_hash: str):
+        with self._lock:
+            self._entries.pop(key_hash, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl_seconds": self.ttl,
+            }
+
+
+api_key_cache = ApiKeyCache(API_KEY_CACHE_TTL, API_KEY_CACHE_SIZE)
+
+
+# Chave substituída ou utilizador removido (chamar depois do commit): sai da cache de todos os processos
+def forget_api_key(key_hash: str):
+    api_key_cache.invalidate(key_hash)
+    invalidation.publish("api_key", key_hash)
+
+
+def forget_remote_api_keys(key_hashes):
+    for key_hash in key_hashes:
+        api_key_cache.invalidate(key_hash)
+
+
+invalidation.subscribe("api_key", forget_remote_api_keys)
+invalidation.subscribe("resync", lambda _: api_key_cache.clear())
+
+
+# Construída uma só vez: é a consulta de todos os pedidos com chave que não estão na cache
+API_KEY_LOOKUP = select(User.id).where(User.api_key_hash == bindparam("key_hash"))
+
+
+# Devolve o id do utilizador dono da chave, ou None se a chave não for válida
+async def lookup_api_key(db: AsyncSession, api_key: str):
+    key_hash = hash_api_key(api_key)
+    user_id = api_key_cache.get(key_hash)
+    if user_id is not None:
+        return user_id
+
+    user_id = await db.scalar(API_KEY_LOOKUP, {"key_hash": key_hash})
+    if user_id is not None:
+        api_key_cache.put(key_hash, user_id)
+    return user_id
+
+
+# Adiciona a coluna api_key_hash se faltar, calcula o hash das chaves que ainda estão em claro e apaga-as
+async def migrate(db: AsyncSession):
+    def has_hash_column(connection):
+        return "api_key_hash" in {c["name"] for c in inspect(connection).get_columns("users")}
+
+    connection = await db.connection()
+    if not await connection.run_sync(has_hash_column):
+        await db.execute(text("ALTER TABLE users ADD COLUMN api_key_hash VARCHAR(64)"))
+        await db.execute(text("CREATE UNIQUE INDEX ix_users_api_key_hash ON users (api_key_hash)"))
+
+    rows = (await db.execute(select(User.id, User.api_key).where(User.api_key.is_not(None)))).all()
+    for user_id, api_key in rows:
+        await db.execute(
+            update(User.__table__)
+            .where(User.id == user_id)
+            .values(api_key_hash=hash_api_key(api_key), api_key=None)
+        )
+    await db.commit()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["migrate"]:
+        print("Uso: python api_keys.py migrate")
+        sys.exit(1)
+
+    async def run_migration():
+        async with AsyncSessionLocal() as db:
+            return await migrate(db)
+
+    migrated = asyncio.run(run_migration())
+
+    print(f"✅ {migrated} chaves de API convertidas para hash.")
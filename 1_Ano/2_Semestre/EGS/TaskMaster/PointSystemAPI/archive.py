@@ -0,0 +1,278 @@
+import asyncio
+import re
+import sys
+from datetime import date, datetime
+
+from sqlalchemy import select, delete, func, literal, text, union_all, bindparam, Integer, String
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import Point, PointArchive
+
+# Particionamento e arquivo do historial de pontos.
+#
+# Em Postgres a tabela points pode ser convertida numa tabela particionada por mês de change_date
+# (partições points_AAAA_MM + points_default para o que ficar fora). Os índices de cada partição ficam pequenos
+# e arquivar um mês é apagar uma partição inteira em vez de um DELETE linha a linha.
+#
+# O arquivo compacta as alterações mais antigas que N meses numa linha por utilizador e por mês em points_archive
+# (soma dos pontos e número de alterações). O historial continua a mostrar esses meses, depois das linhas recentes.
+# Funciona também sem particionamento (e em SQLite), com um DELETE das linhas arquivadas.
+#
+#   python archive.py partition [meses_seguintes]   -> converte points numa tabela particionada (só Postgres)
+#   python archive.py create-partitions [meses]     -> cria as partições dos próximos meses (correr periodicamente)
+#   python archive.py archive [meses_a_manter]      -> arquiva tudo antes do início do mês de há N meses
+
+DEFAULT_MONTHS_AHEAD = 3
+DEFAULT_MONTHS_TO_KEEP = 12
+
+PARTITION_NAME = re.compile(r"^points_(\d{4})_(\d{2})$")
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.year * 12 + day.month - 1 + months
+    return date(month // 12, month % 12 + 1, 1)
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"points_{month.year:04d}_{month.month:02d}"
+
+
+# Historial de um utilizador: linhas de points seguidas dos resumos mensais arquivados, na mesma ordem
+# (change_date DESC, id DESC). Os resumos têm id 0 e change_date no início do mês, por isso o mesmo cursor
+# (change_date, id) pagina pelas duas partes. Com after=True devolve só o que vem depois do cursor.
+# Parâmetros: user_id e, com after, after_date e after_id.
+def history_query(after: bool = False):
+    live = (
+        select(
+            Point.id,
+            Point.points_change,
+            Point.change_date,
+            Point.message,
+            literal(1).label("entries"),
+        )
+        .where(Point.user_id == bindparam("user_id"))
+    )
+    archived = (
+        select(
+            literal(0).label("id"),
+            PointArchive.points_change,
+            PointArchive.month.label("change_date"),
+            literal(None, String).label("message"),
+            PointArchive.entries,
+        )
+        .where(PointArchive.user_id == bindparam("user_id"))
+    )
+    if after:
+        after_date = bindparam("after_date", type_=Point.change_date.type)
+        after_id = bindparam("after_id", type_=Integer)
+        # change_date <= :d fica como condição do índice, o desempate pelo id é só filtro
+        live = live.where(Point.change_date <= after_date).where(
+            (Point.change_date < after_date) | (Point.id < after_id)
+        )
+        # Depois de um resumo (id 0) só os meses anteriores; depois de uma linha normal também o próprio mês
+        archived = archived.where(
+            (PointArchive.month < after_date) | ((PointArchive.month == after_date) & (after_id > 0))
+        )
+    return union_all(live, archived).subquery("history")
+
+
+# As instruções do historial são construídas uma só vez: construir o UNION e calcular a chave da cache
+# de compilação do SQLAlchemy custava mais de 1 ms de CPU por pedido. Só mudam os parâmetros.
+def history_page(after: bool):
+    history = history_query(after)
+    return (
+        select(history)
+        .order_by(history.c.change_date.desc(), history.c.id.desc())
+        .limit(bindparam("limit"))
+        .offset(bindparam("skip"))
+    )
+
+
+HISTORY_FIRST_PAGE = history_page(after=False)  # user_id, limit, skip
+HISTORY_NEXT_PAGE = history_page(after=True)    # user_id, after_date, after_id, limit, skip
+HISTORY_COUNT = select(func.count()).select_from(history_query())  # user_id
+
+
+async def is_partitioned(db: AsyncSession):
+    if db.get_bind().dialect.name != "postgresql":
+        return False
+    return bool(await db.scalar(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'points'::regclass)"
+    )))
+
+
+async def partitions(db: AsyncSession):
+    # {início do mês: nome} das partições mensais existentes
+    names = (await db.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'points'::regclass"
+    ))).scalars().all()
+    result = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            result[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return result
+
+
+async def create_partition(db: AsyncSession, month: date):
+    name = partition_name(month)
+    start, end = month.isoformat(), add_months(month, 1).isoformat()
+    # Se a partição por omissão já tiver linhas deste mês, o Postgres não deixa criar a partição:
+    # tira-se a points_default, cria-se a partição, passam-se as linhas e volta a ligar-se.
+    in_default = await db.scalar(text(
+        "SELECT EXISTS (SELECT 1 FROM points_default WHERE change_date >= :start AND change_date < :end)"
+    ), {"start": month, "end": add_months(month, 1)})
+    if in_default:
+        await db.execute(text("ALTER TABLE points DETACH PARTITION points_default"))
+    await db.execute(text(f"CREATE TABLE {name} PARTITION OF points FOR VALUES FROM ('{start}') TO ('{end}')"))
+    if in_default:
+        await db.execute(text(
+            "WITH moved AS (DELETE FROM points_default WHERE change_date >= :start AND change_date < :end RETURNING *) "
+            "INSERT INTO points SELECT * FROM moved"
+        ), {"start": month, "end": add_months(month, 1)})
+        await db.execute(text("ALTER TABLE points ATTACH PARTITION points_default DEFAULT"))
+
+
+# Cria as partições em falta desde o mês actual até months_ahead meses à frente
+async def create_partitions(db: AsyncSession, months_ahead: int = DEFAULT_MONTHS_AHEAD):
+    if not await is_partitioned(db):
+        raise RuntimeError("A tabela points não está particionada, correr primeiro: python archive.py partition")
+    existing = await partitions(db)
+    this_month = month_start(datetime.utcnow().date())
+    created = []
+    for i in range(months_ahead + 1):
+        month = add_months(this_month, i)
+        if month not in existing:
+            await create_partition(db, month)
+            created.append(partition_name(month))
+    await db.commit()
+    return created
+
+
+# Converte a tabela points numa tabela particionada por mês, copiando as linhas existentes (numa só transação)
+async def partition(db: AsyncSession, months_ahead: int = DEFAULT_MONTHS_AHEAD):
+    if db.get_bind().dialect.name != "postgresql":
+        raise RuntimeError("O particionamento só está disponível em Postgres.")
+    if await is_partitioned(db):
+        return await create_partitions(db, months_ahead)
+
+    await db.execute(text("LOCK TABLE points IN ACCESS EXCLUSIVE MODE"))
+    first = await db.scalar(text("SELECT min(change_date) FROM points"))
+    this_month = month_start(datetime.utcnow().date())
+    month = month_start(first.date()) if first else this_month
+
+    # A chave primária de uma tabela particionada tem que incluir a coluna de partição
+    await db.execute(text(
+        "CREATE TABLE points_partitioned ("
+        " id integer NOT NULL DEFAULT nextval('points_id_seq'),"
+        " user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,"
+        " points_change integer NOT NULL,"
+        " change_date timestamp NOT NULL DEFAULT now(),"
+        " message varchar,"
+        " PRIMARY KEY (id, change_date)"
+        ") PARTITION BY RANGE (change_date)"
+    ))
+    await db.execute(text("CREATE TABLE points_default PARTITION OF points_partitioned DEFAULT"))
+    created = []
+    while month <= add_months(this_month, months_ahead):
+        start, end = month.isoformat(), add_months(month, 1).isoformat()
+        await db.execute(text(
+            f"CREATE TABLE {partition_name(month)} PARTITION OF points_partitioned FOR VALUES FROM ('{start}') TO ('{end}')"
+        ))
+        created.append(partition_name(month))
+        month = add_months(month, 1)
+
+    await db.execute(text(
+        "INSERT INTO points_partitioned (id, user_id, points_change, change_date, message) "
+        "SELECT id, user_id, points_change, coalesce(change_date, now()), message FROM points"
+    ))
+    await db.execute(text("ALTER SEQUENCE points_id_seq OWNED BY points_partitioned.id"))
+    await db.execute(text("DROP TABLE points"))
+    await db.execute(text("ALTER TABLE points_partitioned RENAME TO points"))
+    await db.execute(text("ALTER INDEX points_partitioned_pkey RENAME TO points_pkey"))
+    await db.execute(text("CREATE INDEX ix_points_id ON points (id)"))
+    await db.execute(text("CREATE INDEX ix_points_user_date_id ON points (user_id, change_date DESC, id DESC)"))
+    await db.commit()
+    return created
+
+
+def archive_month(db: AsyncSession):
+    if db.get_bind().dialect.name == "sqlite":
+        # No formato em que o SQLAlchemy guarda datas em SQLite, para comparar bem com os cursores
+        return func.strftime("%Y-%m-01 00:00:00.000000", Point.change_date)
+    return func.date_trunc("month", Point.change_date)
+
+
+# Compacta em points_archive tudo o que é anterior ao início do mês de há months_to_keep meses e remove essas linhas.
+# Em Postgres particionado as partições inteiramente arquivadas são apagadas de uma vez.
+async def archive(db: AsyncSession, months_to_keep: int = DEFAULT_MONTHS_TO_KEEP):
+    cutoff = add_months(month_start(datetime.utcnow().date()), -months_to_keep)
+    cutoff_at = datetime(cutoff.year, cutoff.month, cutoff.day)
+
+    if db.get_bind().dialect.name == "postgresql":
+        upsert = postgresql.insert(PointArchive)
+    else:
+        upsert = sqlite.insert(PointArchive)
+    month = archive_month(db)
+    summary = upsert.from_select(
+        ["user_id", "month", "points_change", "entries"],
+        select(Point.user_id, month, func.sum(Point.points_change), func.count())
+        .where(Point.change_date < cutoff_at)
+        .group_by(Point.user_id, month),
+    )
+    # Se o mês já tinha sido arquivado em parte (linhas escritas depois com datas antigas), soma
+    summary = summary.on_conflict_do_update(
+        index_elements=[PointArchive.user_id, PointArchive.month],
+        set_={
+            "points_change": PointArchive.points_change + summary.excluded.points_change,
+            "entries": PointArchive.entries + summary.excluded.entries,
+        },
+    )
+    await db.execute(summary)
+
+    dropped = []
+    if await is_partitioned(db):
+        for partition_month, name in sorted((await partitions(db)).items()):
+            if add_months(partition_month, 1) <= cutoff:
+                await db.execute(text(f"ALTER TABLE points DETACH PARTITION {name}"))
+                await db.execute(text(f"DROP TABLE {name}"))
+                dropped.append(name)
+
+    # O que sobrar (tabela sem partições ou linhas na points_default)
+    await db.execute(delete(Point).where(Point.change_date < cutoff_at))
+    await db.commit()
+    return cutoff, dropped
+
+
+if __name__ == "__main__":
+    commands = ("partition", "create-partitions", "archive")
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        print("Uso: python archive.py partition|create-partitions [meses_seguintes]")
+        print("     python archive.py archive [meses_a_manter]")
+        sys.exit(1)
+
+    command = sys.argv[1]
+    months = int(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    async def run():
+        async with AsyncSessionLocal() as db:
+            if command == "partition":
+                return await partition(db, months if months is not None else DEFAULT_MONTHS_AHEAD)
+            if command == "create-partitions":
+                return await create_partitions(db, months if months is not None else DEFAULT_MONTHS_AHEAD)
+            return await archive(db, months if months is not None else DEFAULT_MONTHS_TO_KEEP)
+
+    result = asyncio.run(run())
+
+    if command == "archive":
+        cutoff, dropped = result
+        print(f"✅ Historial anterior a {cutoff.isoformat()} arquivado ({len(dropped)} partições removidas).")
+    else:
+        print(f"✅ Partições criadas: {', '.join(result) if result else 'nenhuma'}")
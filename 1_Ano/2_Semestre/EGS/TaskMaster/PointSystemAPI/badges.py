@@ -0,0 +1,225 @@
+import asyncio
+import sys
+import threading
+from bisect import bisect_right
+
+from sqlalchemy import select, update, func, true, bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import invalidation
+from database import AsyncSessionLocal, on_commit
+from models import User, Badge
+
+# Atribuição de badges feita na base de dados: cada utilizador fica com o badge de maior threshold
+# que os seus pontos atingem (ou nenhum), numa única instrução por lote de utilizadores:
+#
+#   UPDATE users SET current_badge_id = best.badge_id
+#   FROM (SELECT u.id, b.id FROM users u LEFT JOIN LATERAL
+#         (SELECT id FROM badges WHERE threshold <= u.total_points ORDER BY threshold DESC LIMIT 1) b ON true
+#         WHERE u.id > :after AND u.id <= :upto) AS best
+#   WHERE users.id = best.user_id AND users.current_badge_id IS DISTINCT FROM best.badge_id
+#   RETURNING ...
+#
+# Só as linhas que mudaram são escritas e devolvidas.
+# Para tabelas grandes corre por lotes de batch_size utilizadores (um commit por lote): python badges.py assign [batch_size]
+# O fim de cada lote é o id do batch_size-ésimo utilizador a seguir ao lote anterior, por isso ids esparsos
+# não dão lotes vazios.
+#
+# Nas alterações de pontos o badge do utilizador é actualizado logo na mesma transação, com uma
+# procura binária nos thresholds guardados em memória (ver BadgeThresholds), sem percorrer os outros utilizadores.
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def best_badges(db: AsyncSession, after_id: int, upto_id: int):
+    u = aliased(User)
+    best_badge = (
+        select(Badge.id)
+        .where(Badge.threshold <= u.total_points)
+        .order_by(Badge.threshold.desc(), Badge.id)
+        .limit(1)
+    )
+    in_batch = (u.id > after_id, u.id <= upto_id)
+
+    if db.get_bind().dialect.name == "postgresql":
+        b = best_badge.lateral("b")
+        return (
+            select(u.id.label("user_id"), b.c.id.label("badge_id"))
+            .select_from(u)
+            .outerjoin(b, true())
+            .where(*in_batch)
+            .subquery("best")
+        )
+
+    # Sem LATERAL (ex.: SQLite): a mesma procura como subconsulta correlacionada
+    return (
+        select(u.id.label("user_id"), best_badge.scalar_subquery().label("badge_id"))
+        .where(*in_batch)
+        .subquery("best")
+    )
+
+
+# Último id do lote seguinte (o maior dos batch_size ids a seguir a after) e quantos utilizadores tem;
+# um lote com menos de batch_size utilizadores é o último
+NEXT_BATCH_IDS = (
+    select(User.id)
+    .where(User.id > bindparam("after"))
+    .order_by(User.id)
+    .limit(bindparam("batch_size"))
+    .subquery("next_batch")
+)
+NEXT_BATCH_END = select(func.max(NEXT_BATCH_IDS.c.id), func.count())
+
+
+# Actualiza os utilizadores com id em ]after_id, upto_id] dentro da transação actual.
+# Devolve [(user_id, name, current_badge_id), ...] apenas para os que mudaram de badge.
+async def assign_badges_batch(db: AsyncSession, after_id: int, upto_id: int):
+    best = best_badges(db, after_id, upto_id)
+    rows = (await db.execute(
+        update(User.__table__)
+        .where(User.id == best.c.user_id, User.current_badge_id.is_distinct_from(best.c.badge_id))
+        .values(current_badge_id=best.c.badge_id)
+        .returning(User.id, User.name, User.current_badge_id)
+    )).all()
+    return [tuple(row) for row in rows]
+
+
+# Percorre a tabela inteira por lotes, com commit no fim de cada um para não manter locks em todos os utilizadores.
+# Devolve a lista de todas as linhas alteradas.
+async def assign_all_badges(db: AsyncSession, batch_size: int = DEFAULT_BATCH_SIZE):
+    changed = []
+    after_id = 0
+    while True:
+        upto_id, users = (await db.execute(NEXT_BATCH_END, {"after": after_id, "batch_size": batch_size})).one()
+        if upto_id is None:
+            return changed
+        changed.extend(await assign_badges_batch(db, after_id, upto_id))
+        await db.commit()
+        if users < batch_size:
+            return changed
+        after_id = upto_id
+
+
+# Antes de remover um badge, dentro da mesma transação: quem o tinha passa para o melhor dos que restam.
+# Os outros utilizadores não mudam, porque o badge removido não era o melhor para eles.
+# Devolve [(user_id, name, current_badge_id), ...] como assign_badges_batch.
+async def reassign_badge_holders(db: AsyncSession, badge_id: int):
+    best_remaining = (
+        select(Badge.id)
+        .where(Badge.id != badge_id, Badge.threshold <= User.total_points)
+        .order_by(Badge.threshold.desc(), Badge.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    rows = (await db.execute(
+        update(User.__table__)
+        .where(User.current_badge_id == badge_id)
+        .values(current_badge_id=best_remaining)
+        .returning(User.id, User.name, User.current_badge_id)
+    )).all()
+    return [tuple(row) for row in rows]
+
+
+class BadgeThresholds:
+    # Thresholds dos badges ordenados de forma crescente, carregados da base de dados na primeira utilização.
+    # Em empates de threshold fica o badge de menor id, como na atribuição em SQL.
+    # Criar ou remover um badge invalida a cache depois do commit, também nos outros processos.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thresholds = None
+        self._badge_ids = None
+        self._version = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._thresholds = None
+            self._badge_ids = None
+            self._version += 1
+
+    async def _load(self, db: AsyncSession):
+        with self._lock:
+            if self._thresholds is not None:
+                return self._thresholds, self._badge_ids
+            version = self._version
+        rows = (await db.execute(
+            select(Badge.threshold, Badge.id)
+            .where(Badge.threshold.is_not(None))
+            .order_by(Badge.threshold, Badge.id.desc())
+        )).all()
+        thresholds = [threshold for threshold, _ in rows]
+        badge_ids = [badge_id for _, badge_id in rows]
+        with self._lock:
+            # Se houve uma invalidação durante a leitura, o resultado pode estar desactualizado e não fica em cache
+            if self._version == version:
+                self._thresholds, self._badge_ids = thresholds, badge_ids
+        return thresholds, badge_ids
+
+    async def badge_for(self, db: AsyncSession, total_points: int):
+        # Badge de maior threshold <= total_points, ou None
+        thresholds, badge_ids = await self._load(db)
+        i = bisect_right(thresholds, total_points)
+        return badge_ids[i - 1] if i > 0 else None
+
+
+badge_thresholds = BadgeThresholds()
+
+
+# Chamado depois de alterar os pontos de um utilizador, dentro da mesma transação.
+# Devolve (mudou, badge_id) para quem precise de saber se o badge mudou (ex.: o stream de eventos).
+async def update_user_badge(db: AsyncSession, user_id: int, total_points: int):
+    badge_id = await badge_thresholds.badge_for(db, total_points)
+    result = await db.execute(
+        update(User.__table__)
+        .where(User.id == user_id, User.current_badge_id.is_distinct_from(badge_id))
+        .values(current_badge_id=badge_id)
+    )
+    return result.rowcount > 0, badge_id
+
+
+# Versão para as atribuições em massa: totals é {user_id: total_points}.
+# Um UPDATE por badge distinto (são poucos), cada um com a lista dos utilizadores que o devem ter.
+async def update_user_badges(db: AsyncSession, totals):
+    by_badge = {}
+    for user_id, total_points in totals.items():
+        badge_id = await badge_thresholds.badge_for(db, total_points)
+        by_badge.setdefault(badge_id, []).append(user_id)
+
+    for badge_id, user_ids in by_badge.items():
+        await db.execute(
+            update(User.__table__)
+            .where(User.id.in_(bindparam("user_ids", expanding=True)), User.current_badge_id.is_distinct_from(badge_id))
+            .values(current_badge_id=badge_id),
+            {"user_ids": user_ids},
+        )
+
+
+def thresholds_changed():
+    badge_thresholds.invalidate()
+    invalidation.publish("badges")
+
+
+# Depois de criar ou remover um badge a cache é invalidada no commit
+def badges_changed(db: AsyncSession):
+    on_commit(db, thresholds_changed)
+
+
+invalidation.subscribe("badges", lambda _: badge_thresholds.invalidate())
+invalidation.subscribe("resync", lambda _: badge_thresholds.invalidate())
+
+
+if __name__ == "__main__":
+    if not sys.argv[1:] or sys.argv[1] != "assign":
+        print("Uso: python badges.py assign [batch_size]")
+        sys.exit(1)
+
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATCH_SIZE
+
+    async def assign():
+        async with AsyncSessionLocal() as db:
+            return await assign_all_badges(db, batch_size)
+
+    changed = asyncio.run(assign())
+
+    print(f"✅ Badges atribuídos: {len(changed)} utilizadores alterados.")
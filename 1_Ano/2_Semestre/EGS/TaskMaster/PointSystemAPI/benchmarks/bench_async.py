@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import os
+import random
+import secrets
+import sys
+import time
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+from fastapi import FastAPI, Depends, HTTPException, Query
+from sqlalchemy import create_engine, desc, delete, insert
+from sqlalchemy.orm import Session, sessionmaker
+
+import main
+from migrate import create_schema
+from api_keys import hash_api_key
+from database import DATABASE_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, SessionLocal
+from models import User, Point
+
+# Compara pedidos/s entre o caminho síncrono antigo (SessionLocal, handlers na threadpool do FastAPI)
+# e o caminho assíncrono actual (AsyncSessionLocal) para os mesmos endpoints.
+# Os pedidos passam pela app ASGI dentro do processo (httpx.ASGITransport), sem rede pelo meio.
+#
+# Uso: python benchmarks/bench_async.py --requests 2000 --concurrency 50
+# (requer httpx; os dois caminhos usam o mesmo tamanho de pool, DB_POOL_SIZE / DB_MAX_OVERFLOW)
+#
+# O validate_api_key antigo era "async def" com sessão síncrona: sob carga fica à espera de uma ligação do pool
+# dentro do event loop, enquanto as sessões que a têm precisam do event loop para a devolver, e o processo pára
+# até ao pool_timeout. Aqui a cópia usa "def" (threadpool) para a comparação ser com o melhor caso síncrono.
+# Pedidos que falhem (ex.: pool_timeout) contam como erros.
+
+legacy = FastAPI()
+
+if DATABASE_URL.startswith("sqlite"):
+    legacy_engine = create_engine(DATABASE_URL)
+else:
+    legacy_engine = create_engine(DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=5)
+LegacySession = sessionmaker(autocommit=False, autoflush=False, bind=legacy_engine)
+
+
+def get_sync_db():
+    db = LegacySession()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+# Cópias dos handlers como estavam antes do caminho assíncrono
+@legacy.get("/v1/validate-api-key")
+def validate_api_key(api_key: str, db: Session = Depends(get_sync_db)):
+    user = db.query(User).filter(User.api_key == api_key).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="API key inválida.")
+    return {"valid": True, "user_id": user.id}
+
+
+@legacy.get("/v1/points/history/{user_id}")
+def get_user_points_history(user_id: int, db: Session = Depends(get_sync_db), skip: int = Query(0, ge=0), limit: int = Query(10, ge=1, le=100)):
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+    total_results = db.query(Point).filter(Point.user_id == user_id).count()
+    history = db.query(Point).filter(Point.user_id == user_id).order_by(desc(Point.change_date)).offset(skip).limit(limit).all()
+    return {
+        "user_id": user.id,
+        "total_results": total_results,
+        "history": [{"points_change": p.points_change, "change_date": p.change_date.isoformat(), "message": p.message} for p in history],
+    }
+
+
+@legacy.post("/v1/users/{user_id}/points/")
+def add_points(user_id: int, points: int, message: str, db: Session = Depends(get_sync_db)):
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+    db.add(Point(user_id=user_id, points_change=points, message=message))
+    user.total_points += points
+    db.commit()
+    return {"message": "Pontos atribuidos com sucesso!", "total_points": user.total_points}
+
+
+def seed(users, points_per_user):
+    db = SessionLocal()
+    keys = [secrets.token_hex(32) for _ in range(users)]
+    # O caminho antigo procura a chave em claro, o actual pelo hash: ficam as duas colunas preenchidas
+    db.execute(insert(User.__table__), [
+        {"name": f"bench{i}", "email": f"bench{i}-{secrets.token_hex(4)}@bench.local", "total_points": 0, "api_key": key, "api_key_hash": hash_api_key(key)}
+        for i, key in enumerate(keys)
+    ])
+    db.commit()
+    rows = db.query(User.id, User.api_key).filter(User.email.like("%@bench.local")).all()
+    db.execute(insert(Point.__table__), [
+        {"user_id": user_id, "points_change": 1, "message": "bench"}
+        for user_id, _ in rows
+        for _ in range(points_per_user)
+    ])
+    db.commit()
+    db.close()
+    return rows
+
+
+def cleanup():
+    db = SessionLocal()
+    ids = [user_id for (user_id,) in db.query(User.id).filter(User.email.like("%@bench.local")).all()]
+    db.execute(delete(Point).where(Point.user_id.in_(ids)))
+    db.execute(delete(User).where(User.id.in_(ids)))
+    db.commit()
+    db.close()
+
+
+async def run(app, name, rows, total, concurrency):
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        requests = {
+            "validate-api-key": lambda user_id, key: client.get("/v1/validate-api-key", params={"api_key": key}),
+            "history": lambda user_id, key: client.get(f"/v1/points/history/{user_id}"),
+            "add-points": lambda user_id, key: client.post(f"/v1/users/{user_id}/points/", params={"points": 1, "message": "bench"}),
+        }
+        for endpoint, request in requests.items():
+            queue = asyncio.Queue()
+            for _ in range(total):
+                queue.put_nowait(random.choice(rows))
+
+            errors = 0
+
+            async def worker():
+                nonlocal errors
+                while not queue.empty():
+                    user_id, key = queue.get_nowait()
+                    response = await request(user_id, key)
+                    if response.status_code != 200:
+                        errors += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - start
+            print(f"{name:>6} {endpoint:>17}: {total / elapsed:8.0f} pedidos/s, {errors} erros")
+
+
+async def bench(args):
+    rows = seed(args.users, args.points)
+    try:
+        await main.load_leaderboard()
+        for name, app in (("sync", legacy), ("async", main.app)):
+            await run(app, name, rows, args.requests, args.concurrency)
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=20, help="linhas de historial por utilizador")
+    parser.add_argument("--requests", type=int, default=2000, help="pedidos por endpoint")
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    create_schema()
+    asyncio.run(bench(args))
@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import os
+import secrets
+import sys
+import time
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import joinedload
+
+import main
+from migrate import create_schema
+import serialization
+from database import AsyncSessionLocal, SessionLocal
+from models import User
+
+# CPU por pedido para construir e serializar um ranking de N utilizadores (por omissão 10k):
+#   orm  -> select(User) com entidades ORM (e o badge carregado com elas), dicts, jsonable_encoder e JSONResponse
+#           (como o /v1/users/ fazia)
+#   lean -> tuplos de colunas (ranking_query) e serialization.dumps (orjson se instalado)
+# Mede-se o tempo de CPU do processo (time.process_time), separado em query+hidratação e serialização,
+# por isso a espera pela base de dados não conta. Os dois caminhos têm que produzir o mesmo JSON.
+#
+# Uso: python benchmarks/bench_serialization.py --users 10000 --repeat 20
+
+
+def seed(users):
+    db = SessionLocal()
+    db.execute(insert(User.__table__), [
+        {"name": f"bench{i}", "email": f"bench{i}-{secrets.token_hex(4)}@bench.local", "total_points": i % 997}
+        for i in range(users)
+    ])
+    db.commit()
+    db.close()
+
+
+def cleanup():
+    db = SessionLocal()
+    db.execute(delete(User).where(User.email.like("%@bench.local")))
+    db.commit()
+    db.close()
+
+
+def ranking_dicts(rows, badge_name):
+    return {
+        "ranking": [
+            {
+                "rank": position,
+                "user_id": row.id,
+                "name": row.name,
+                "email": row.email,
+                "total_points": row.total_points,
+                "badge": badge_name(row)
+            }
+            for position, row in enumerate(rows, start=1)
+        ]
+    }
+
+
+async def orm_path(db):
+    start = time.process_time()
+    users = (await db.scalars(
+        select(User).options(joinedload(User.current_badge)).order_by(User.total_points.desc(), User.id)
+    )).unique().all()
+    data = ranking_dicts(users, lambda user: user.current_badge.name if user.current_badge else None)
+    loaded = time.process_time()
+    body = JSONResponse(content=jsonable_encoder(data)).body
+    return loaded - start, time.process_time() - loaded, body
+
+
+async def lean_path(db):
+    start = time.process_time()
+    rows = (await db.execute(main.ranking_query().order_by(User.total_points.desc(), User.id))).all()
+    data = ranking_dicts(rows, lambda row: row.badge_name if row.badge_name else None)
+    loaded = time.process_time()
+    body = serialization.dumps(data)
+    return loaded - start, time.process_time() - loaded, body
+
+
+async def bench(args):
+    seed(args.users)
+    try:
+        bodies = {}
+        for name, path in (("orm", orm_path), ("lean", lean_path)):
+            load_total = dump_total = 0.0
+            for _ in range(args.repeat):
+                # Sessão nova por pedido, como no get_db
+                async with AsyncSessionLocal() as db:
+                    load, dump, body = await path(db)
+                load_total += load
+                dump_total += dump
+            bodies[name] = body
+            load_ms = load_total / args.repeat * 1000
+            dump_ms = dump_total / args.repeat * 1000
+            print(f"{name:>5}: {load_ms:7.1f} ms query+hidratação, {dump_ms:7.1f} ms serialização, "
+                  f"{load_ms + dump_ms:7.1f} ms CPU por pedido ({len(body) // 1024} KiB)")
+        print(f"mesmo JSON: {bodies['orm'] == bodies['lean']}, orjson: {serialization.orjson is not None}")
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20, help="pedidos por caminho")
+    args = parser.parse_args()
+
+    create_schema()
+    asyncio.run(bench(args))
@@ -0,0 +1,170 @@
+import argparse
+import asyncio
+import os
+import secrets
+import sys
+import time
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import delete, insert, select, func, literal, union_all, make_url, String
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+import main
+from migrate import create_schema
+from api_keys import API_KEY_LOOKUP, hash_api_key
+from archive import HISTORY_FIRST_PAGE, HISTORY_COUNT
+from database import ASYNC_DATABASE_URL, SessionLocal, engine
+from models import User, Point, PointArchive
+
+# Custo do lado do Python de construir e compilar as consultas mais frequentes, antes e depois de serem
+# construídas uma só vez (API_KEY_LOOKUP, USER_SUMMARY, HISTORY_*):
+#   antes  -> instrução construída em cada pedido (o db.query(...) antigo construía o mesmo select)
+#   depois -> instrução construída no arranque, só mudam os parâmetros
+# Para cada uma mede-se, sem base de dados:
+#   construção + chave da cache de compilação (o que o SQLAlchemy calcula em cada execute)
+#   compilação sem cache (o que custaria cada pedido se a cache de compilação não existisse)
+# e depois o pedido completo (as consultas de um pedido ao historial + validação de chave) contra DATABASE_URL,
+# em CPU do processo e em tempo real, com e sem os prepared statements do asyncpg.
+#
+# Uso: python benchmarks/bench_statements.py --repeat 2000 --requests 500
+
+# O historial como era construído antes (archive.history_query com o user_id e o cursor como valores)
+def history_query_before(user_id: int, after=None):
+    live = (
+        select(Point.id, Point.points_change, Point.change_date, Point.message, literal(1).label("entries"))
+        .where(Point.user_id == user_id)
+    )
+    archived = (
+        select(
+            literal(0).label("id"),
+            PointArchive.points_change,
+            PointArchive.month.label("change_date"),
+            literal(None, String).label("message"),
+            PointArchive.entries,
+        )
+        .where(PointArchive.user_id == user_id)
+    )
+    if after is not None:
+        change_date, point_id = after
+        live = live.where(Point.change_date <= change_date).where(
+            (Point.change_date < change_date) | (Point.id < point_id)
+        )
+        archived = archived.where(PointArchive.month < change_date) if point_id <= 0 else archived.where(
+            PointArchive.month <= change_date
+        )
+    return union_all(live, archived).subquery("history")
+
+
+def history_page_before(user_id: int):
+    history = history_query_before(user_id)
+    return select(history).order_by(history.c.change_date.desc(), history.c.id.desc()).limit(11)
+
+
+BUILT = {
+    "api-key": lambda key_hash, user_id: select(User.id).where(User.api_key_hash == key_hash),
+    "user": lambda key_hash, user_id: select(User.id, User.name, User.email, User.total_points).where(User.id == user_id),
+    "history-page": lambda key_hash, user_id: history_page_before(user_id),
+    "history-count": lambda key_hash, user_id: select(func.count()).select_from(history_query_before(user_id)),
+}
+
+PREBUILT = {
+    "api-key": API_KEY_LOOKUP,
+    "user": main.USER_SUMMARY,
+    "history-page": HISTORY_FIRST_PAGE,
+    "history-count": HISTORY_COUNT,
+}
+
+
+def per_call_us(fn, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat * 1e6
+
+
+def measure_python(dialect, repeat):
+    print(f"{'consulta':>14} {'construir+chave antes':>22} {'depois':>8} {'compilar sem cache':>19}")
+    for name, build in BUILT.items():
+        before = per_call_us(lambda: build("x" * 64, 1)._generate_cache_key(), repeat)
+        after = per_call_us(lambda: PREBUILT[name]._generate_cache_key(), repeat)
+        compile_us = per_call_us(lambda: PREBUILT[name].compile(dialect=dialect), max(repeat // 10, 1))
+        print(f"{name:>14} {before:19.1f} µs {after:5.1f} µs {compile_us:16.1f} µs")
+
+
+def seed():
+    db = SessionLocal()
+    key = secrets.token_hex(32)
+    db.execute(insert(User.__table__), [{
+        "name": "bench", "email": f"bench-{secrets.token_hex(4)}@bench.local", "total_points": 0, "api_key_hash": hash_api_key(key)
+    }])
+    db.commit()
+    user_id = db.scalar(select(User.id).where(User.api_key_hash == hash_api_key(key)))
+    db.execute(insert(Point.__table__), [{"user_id": user_id, "points_change": 1, "message": "bench"} for _ in range(50)])
+    db.commit()
+    db.close()
+    return user_id, hash_api_key(key)
+
+
+def cleanup():
+    db = SessionLocal()
+    ids = [user_id for (user_id,) in db.query(User.id).filter(User.email.like("%@bench.local")).all()]
+    db.execute(delete(Point).where(Point.user_id.in_(ids)))
+    db.execute(delete(User).where(User.id.in_(ids)))
+    db.commit()
+    db.close()
+
+
+async def measure_requests(url, label, user_id, key_hash, repeat):
+    async_engine = create_async_engine(url)
+    Session = async_sessionmaker(async_engine, expire_on_commit=False)
+
+    async def request_built(db):
+        await db.scalar(BUILT["api-key"](key_hash, user_id))
+        (await db.execute(BUILT["user"](key_hash, user_id))).first()
+        (await db.execute(BUILT["history-page"](key_hash, user_id))).all()
+        await db.scalar(BUILT["history-count"](key_hash, user_id))
+
+    async def request_prebuilt(db):
+        await db.scalar(API_KEY_LOOKUP, {"key_hash": key_hash})
+        (await db.execute(main.USER_SUMMARY, {"user_id": user_id})).first()
+        (await db.execute(HISTORY_FIRST_PAGE, {"user_id": user_id, "limit": 11, "skip": 0})).all()
+        await db.scalar(HISTORY_COUNT, {"user_id": user_id})
+
+    for name, request in (("antes", request_built), ("depois", request_prebuilt)):
+        async with Session() as db:
+            await request(db)  # Aquece a cache de compilação e a ligação
+            cpu, wall = time.process_time(), time.perf_counter()
+            for _ in range(repeat):
+                await request(db)
+            cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        print(f"{label:>26} {name:>6}: {cpu / repeat * 1e6:8.0f} µs CPU, {wall / repeat * 1e6:8.0f} µs por pedido")
+
+    await async_engine.dispose()
+
+
+async def bench(args):
+    user_id, key_hash = seed()
+    try:
+        urls = [(ASYNC_DATABASE_URL, "")]
+        if ASYNC_DATABASE_URL.startswith("postgresql+asyncpg"):
+            urls = [
+                (make_url(ASYNC_DATABASE_URL).update_query_dict({"prepared_statement_cache_size": "100"}), "prepared statements"),
+                (make_url(ASYNC_DATABASE_URL).update_query_dict({"prepared_statement_cache_size": "0"}), "sem prepared statements"),
+            ]
+        for url, label in urls:
+            await measure_requests(url, label, user_id, key_hash, args.requests)
+    finally:
+        cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=2000, help="repetições das medições sem base de dados")
+    parser.add_argument("--requests", type=int, default=500, help="pedidos completos contra a base de dados")
+    args = parser.parse_args()
+
+    create_schema()
+    measure_python(engine.dialect, args.repeat)
+    asyncio.run(bench(args))
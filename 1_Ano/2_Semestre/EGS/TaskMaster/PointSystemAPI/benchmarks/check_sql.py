@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import os
+import re
+import secrets
+import sys
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+from sqlalchemy import event
+
+import main
+from migrate import create_schema
+from database import engines
+from leaderboard import leaderboard, MemoryLeaderboard
+
+# Verifica o SQL que cada endpoint emite, para os caminhos frequentes não voltarem a pagar por joins
+# ou colunas que não usam (ex.: o badge carregado com cada User, ou a entidade User inteira para escrever um campo).
+# Corre uma sequência de pedidos contra a app ASGI dentro do processo e, para cada um, confirma:
+#   - que responde com sucesso
+#   - que não emite mais do que o número de instruções esperado
+#   - que nenhuma instrução faz JOIN com badges, salvo nos endpoints que mostram o badge
+#   - que nenhuma instrução lê a linha inteira de users (a entidade User), salvo onde é precisa
+# Sai com código 1 se alguma verificação falhar. Usa DATABASE_URL, que deve ser uma base de dados de testes.
+#
+# Uso: python benchmarks/check_sql.py [-v]
+
+JOIN_BADGES = re.compile(r"JOIN badges", re.IGNORECASE)
+FULL_USER = re.compile(r"users\.api_key(\s+AS\s+\w+)?,\s*users\.api_key_hash", re.IGNORECASE)
+
+
+class Check:
+
+    def __init__(self, name, method, url, max_statements, badge_join=False, full_user=False, **kwargs):
+        self.name = name
+        self.method = method
+        self.url = url
+        self.max_statements = max_statements
+        self.badge_join = badge_join
+        self.full_user = full_user
+        self.kwargs = kwargs
+
+
+def checks(user_id, email, quest_id, tag):
+    return [
+        Check("add_points", "POST", f"/v1/users/{user_id}/points/", 6, params={"points": 10, "message": "sql"}),
+        Check("remove_points", "DELETE", f"/v1/users/{user_id}/points/", 6, params={"points": 1, "message": "sql"}),
+        Check("update_user", "PATCH", f"/v1/users/{user_id}/", 1, json={"name": "sql", "email": email}),
+        Check("upsert_user", "PUT", f"/v1/users/by-email/{email}", 2, json={"name": "sql"}),
+        Check("user_by_email", "GET", f"/v1/users/by-email/{email}", 1),
+        Check("generate_api_key", "POST", "/v1/generate-api-key", 2, params={"user_id": user_id}),
+        Check("rank", "GET", f"/v1/users/{user_id}/rank", 1),
+        Check("history", "GET", f"/v1/points/history/{user_id}", 3, params={"limit": 10}),
+        Check("get_users", "GET", "/v1/users/", 2, badge_join=True, params={"limit": 50}),
+        Check("leaderboards", "GET", "/v1/leaderboards", 2, badge_join=True, params={"window": "7d"}),
+        Check("create_quest", "POST", "/v1/quests/", 2, params={"user_id": user_id},
+              json={"title": f"sql-{tag}", "description": "sql", "points": 5}),
+        Check("complete_quest", "POST", f"/v1/quests/{quest_id}/complete", 6),
+        Check("user_quests", "GET", f"/v1/quests/user/{user_id}", 2),
+        Check("user_quests_page", "GET", f"/v1/quests/user/{user_id}", 2, params={"completed": "false", "limit": 10}),
+        Check("assign_badges", "POST", "/v1/badge/assign", 4),
+        # O ORM apaga o utilizador (e o historial em cascata), por isso aqui a entidade é carregada
+        Check("remove_user", "DELETE", f"/v1/users/{user_id}", 10, full_user=True),
+    ]
+
+
+def capture(statements):
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(" ".join(statement.split()))
+    for sync_engine in engines.values():
+        event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+
+
+def verify(check, response, sql):
+    problems = []
+    if response.status_code >= 400:
+        problems.append(f"resposta {response.status_code}: {response.text[:200]}")
+    if len(sql) > check.max_statements:
+        problems.append(f"{len(sql)} instruções (máximo {check.max_statements})")
+    if not check.badge_join and any(JOIN_BADGES.search(statement) for statement in sql):
+        problems.append("JOIN com badges num endpoint que não mostra o badge")
+    if not check.full_user and any(FULL_USER.search(statement) for statement in sql):
+        problems.append("lê a entidade User inteira")
+    return problems
+
+
+async def run(verbose):
+    statements = []
+    capture(statements)
+    for handler in main.app.router.on_startup:
+        await handler()
+    # Os orçamentos são os do leaderboard em memória já carregado (antes disso o rank vai à base de dados)
+    if isinstance(leaderboard, MemoryLeaderboard):
+        await leaderboard.wait_loaded()
+
+    tag = secrets.token_hex(4)
+    email = f"sql-{tag}@example.com"
+    failures = 0
+    transport = httpx.ASGITransport(app=main.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://check") as client:
+        # Dados para os pedidos: um utilizador, um badge e uma quest
+        await client.post("/v1/users/", json={"name": "sql", "email": email})
+        user_id = (await client.get(f"/v1/users/by-email/{email}")).json()["user_id"]
+        await client.post("/v1/badge", params={"name": f"sql-{tag}", "threshold": 5, "image_filename": "sql.png"})
+        await client.post("/v1/quests/", params={"user_id": user_id}, json={"title": f"sql-{tag}", "description": "sql", "points": 5})
+        quest_id = (await client.get(f"/v1/quests/user/{user_id}")).json()[0]["id"]
+
+        for check in checks(user_id, email, quest_id, tag):
+            statements.clear()
+            response = await client.request(check.method, check.url, **check.kwargs)
+            sql = list(statements)
+            problems = verify(check, response, sql)
+            failures += bool(problems)
+            print(f"{'✅' if not problems else '❌'} {check.name:>17}: {len(sql)} instruções"
+                  + (f" -> {'; '.join(problems)}" if problems else ""))
+            if verbose or problems:
+                for statement in sql:
+                    print(f"      {statement[:200]}")
+
+        badge_id = next(
+            badge["id"] for badge in (await client.get("/v1/badges")).json() if badge["name"] == f"sql-{tag}"
+        )
+        await client.delete(f"/v1/badges/{badge_id}")
+
+    for handler in main.app.router.on_shutdown:
+        await handler()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-v", "--verbose", action="store_true", help="mostra o SQL de todos os pedidos")
+    args = parser.parse_args()
+
+    create_schema()
+    failures = asyncio.run(run(args.verbose))
+    if failures:
+        print(f"{failures} endpoint(s) com SQL inesperado")
+        sys.exit(1)
+    print("✅ SQL de todos os endpoints dentro do esperado")
@@ -0,0 +1,75 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+# Tempo de arranque a frio de um processo da API, contra a base de dados de DATABASE_URL:
+#   import   -> python -X importtime -c "import main": tempo total do import e os módulos mais pesados
+#   primeiro pedido -> desde o lançamento do uvicorn até ao primeiro 200 (import + arranque da app + pedido)
+# Cada medição é repetida --repeat vezes num processo novo e mostra-se a mediana.
+#
+# Uso: python benchmarks/cold_start.py --repeat 5
+
+APP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def import_times():
+    # Devolve (total do import de main em ms, [(ms acumulados, módulo), ...] dos imports directos de main)
+    output = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=APP_DIR, capture_output=True, text=True, check=True,
+    ).stderr
+    total = 0.0
+    children = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if name.strip() == "main" and not name.startswith("  "):
+            total = int(cumulative) / 1000
+        elif name.startswith("   ") and not name.startswith("    "):
+            children.append((int(cumulative) / 1000, name.strip()))
+    return total, sorted(children, reverse=True)
+
+
+def time_to_first_request(port, path):
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=APP_DIR,
+    )
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=5) as client:
+            while time.perf_counter() - start < 60:
+                if server.poll() is not None:
+                    raise SystemExit("O servidor terminou durante o arranque")
+                try:
+                    if client.get(path).status_code == 200:
+                        return (time.perf_counter() - start) * 1000
+                except httpx.TransportError:
+                    time.sleep(0.01)
+        raise SystemExit("O servidor não respondeu a tempo")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--path", default="/v1/users/?limit=10", help="pedido usado para o primeiro 200")
+    args = parser.parse_args()
+
+    imports = [import_times() for _ in range(args.repeat)]
+    print(f"import main: {statistics.median(total for total, _ in imports):.0f} ms (mediana de {args.repeat})")
+    for cumulative, name in imports[-1][1][:10]:
+        print(f"  {cumulative:8.1f} ms  {name}")
+
+    first = [time_to_first_request(args.port, args.path) for _ in range(args.repeat)]
+    print(f"primeiro pedido: {statistics.median(first):.0f} ms (mediana de {args.repeat}, "
+          f"mín {min(first):.0f}, máx {max(first):.0f})")
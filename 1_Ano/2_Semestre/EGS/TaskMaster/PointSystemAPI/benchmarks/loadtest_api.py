@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+from sqlalchemy import delete, insert, select
+
+import main
+from migrate import create_schema
+from api_keys import hash_api_key
+from database import SessionLocal, AsyncSessionLocal, engine
+from leaderboard import leaderboard, MemoryLeaderboard
+from models import User, Point, Badge, DailyPoints, UserRank
+
+# Teste de carga reprodutível da API com uma mistura de pedidos realista:
+#   1. semeia N utilizadores (com chave de API), M alterações de pontos por utilizador e B badges
+#      na base de dados de DATABASE_URL (Postgres ou SQLite; usar uma base de dados própria para testes)
+#   2. durante --duration segundos, --concurrency clientes escolhem pedidos ao acaso segundo --mix
+#   3. mostra pedidos/s e latências p50/p95/p99 por endpoint e grava tudo em JSON
+#   4. com --compare, mostra a diferença para um resultado anterior (ex.: de outro commit)
+#
+# Por omissão os pedidos passam pela app ASGI dentro do processo (httpx.ASGITransport, sem rede).
+# Com --url os pedidos vão para um servidor já a correr (ex.: uvicorn main:app), que tem que usar a mesma base de dados.
+#
+# Uso: python benchmarks/loadtest_api.py --users 1000 --points 20 --duration 30 --concurrency 50
+#      python benchmarks/loadtest_api.py --url http://localhost:8000 --compare benchmarks/results/abc1234.json
+
+DEFAULT_MIX = "get_users=35,history=25,add_points=20,validate_api_key=15,assign_badges=5"
+
+
+def requests_for(client, rng):
+    # Cada entrada recebe (utilizador, chave de API) e devolve o pedido a fazer
+    return {
+        "get_users": lambda user_id, key: client.get("/v1/users/", params={"limit": 50}),
+        "history": lambda user_id, key: client.get(f"/v1/points/history/{user_id}", params={"limit": 10}),
+        "add_points": lambda user_id, key: client.post(
+            f"/v1/users/{user_id}/points/", params={"points": rng.randint(1, 10), "message": "bench"}
+        ),
+        "validate_api_key": lambda user_id, key: client.get("/v1/validate-api-key", params={"api_key": key}),
+        "assign_badges": lambda user_id, key: client.post("/v1/badge/assign"),
+    }
+
+
+def parse_mix(mix: str):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def seed(users, points_per_user, badges, rng):
+    db = SessionLocal()
+    tag = secrets.token_hex(4)
+    keys = [secrets.token_hex(32) for _ in range(users)]
+    changes = [[rng.randint(1, 10) for _ in range(points_per_user)] for _ in range(users)]
+    db.execute(insert(User.__table__), [
+        {
+            "name": f"bench{i}",
+            "email": f"bench{i}-{tag}@bench.local",
+            "total_points": sum(changes[i]),
+            "api_key_hash": hash_api_key(key),
+        }
+        for i, key in enumerate(keys)
+    ])
+    ids = dict(db.execute(
+        select(User.email, User.id).where(User.email.like(f"%-{tag}@bench.local"))
+    ).all())
+    rows = [(ids[f"bench{i}-{tag}@bench.local"], keys[i]) for i in range(users)]
+
+    # Historial em lotes, para não ter milhões de linhas em memória de uma vez
+    batch = []
+    for (user_id, _), user_changes in zip(rows, changes):
+        batch.extend({"user_id": user_id, "points_change": change, "message": "bench"} for change in user_changes)
+        if len(batch) >= 50000:
+            db.execute(insert(Point.__table__), batch)
+            batch = []
+    if batch:
+        db.execute(insert(Point.__table__), batch)
+
+    # Badges com limites espalhados pelos totais semeados
+    top = max((sum(c) for c in changes), default=0)
+    db.execute(insert(Badge.__table__), [
+        {"name": f"bench-{tag}-{i}", "description": "bench", "image_filename": "bench.png", "threshold": top * i // max(badges, 1)}
+        for i in range(badges)
+    ])
+    db.commit()
+    db.close()
+    return rows, tag
+
+
+def cleanup(tag):
+    db = SessionLocal()
+    ids = [user_id for (user_id,) in db.execute(select(User.id).where(User.email.like(f"%-{tag}@bench.local"))).all()]
+    badge_ids = [badge_id for (badge_id,) in db.execute(select(Badge.id).where(Badge.name.like(f"bench-{tag}-%"))).all()]
+    # Em SQLite as chaves estrangeiras não apagam em cascata
+    for model in (Point, DailyPoints, UserRank):
+        db.execute(delete(model).where(model.user_id.in_(ids)))
+    db.execute(delete(User).where(User.id.in_(ids)))
+    db.execute(User.__table__.update().where(User.current_badge_id.in_(badge_ids)).values(current_badge_id=None))
+    db.execute(delete(Badge).where(Badge.id.in_(badge_ids)))
+    db.commit()
+    db.close()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    results = {}
+    for name, values in latencies.items():
+        values = sorted(values)
+        results[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1000 if values else None,
+            "p95_ms": percentile(values, 95) * 1000 if values else None,
+            "p99_ms": percentile(values, 99) * 1000 if values else None,
+            "mean_ms": sum(values) / len(values) * 1000 if values else None,
+            "max_ms": values[-1] * 1000 if values else None,
+        }
+    every = sorted(v for values in latencies.values() for v in values)
+    results["total"] = {
+        "requests": len(every),
+        "errors": sum(errors.values()),
+        "rps": len(every) / elapsed,
+        "p50_ms": percentile(every, 50) * 1000 if every else None,
+        "p95_ms": percentile(every, 95) * 1000 if every else None,
+        "p99_ms": percentile(every, 99) * 1000 if every else None,
+        "mean_ms": sum(every) / len(every) * 1000 if every else None,
+        "max_ms": every[-1] * 1000 if every else None,
+    }
+    return results
+
+
+async def run(client, rows, args, rng):
+    weights = parse_mix(args.mix)
+    requests = requests_for(client, rng)
+    unknown = set(weights) - set(requests)
+    if unknown:
+        raise SystemExit(f"Endpoints desconhecidos em --mix: {', '.join(sorted(unknown))} (disponíveis: {', '.join(requests)})")
+    names = list(weights)
+    cumulative = list(weights.values())
+
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    async def worker(deadline):
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, cumulative)[0]
+            user_id, key = rng.choice(rows)
+            start = time.perf_counter()
+            try:
+                response = await requests[name](user_id, key)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            latencies[name].append(time.perf_counter() - start)
+            if not ok:
+                errors[name] += 1
+
+    # Aquecimento (caches, pool de ligações), fora das medições
+    if args.warmup > 0:
+        await asyncio.gather(*(worker(time.perf_counter() + args.warmup) for _ in range(args.concurrency)))
+        latencies = {name: [] for name in names}
+        errors = {name: 0 for name in names}
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(start + args.duration) for _ in range(args.concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "desconhecido"
+
+
+def print_results(results, previous=None):
+    print(f"{'endpoint':>17} {'pedidos':>8} {'erros':>6} {'pedidos/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, r in results.items():
+        line = (f"{name:>17} {r['requests']:8d} {r['errors']:6d} {r['rps']:10.1f} "
+                f"{r['p50_ms'] or 0:8.1f} {r['p95_ms'] or 0:8.1f} {r['p99_ms'] or 0:8.1f}")
+        old = (previous or {}).get(name)
+        if old and old.get("rps") and old.get("p95_ms") and r["p95_ms"]:
+            line += f"   ({(r['rps'] / old['rps'] - 1) * 100:+.0f}% pedidos/s, {(r['p95_ms'] / old['p95_ms'] - 1) * 100:+.0f}% p95)"
+        print(line)
+
+
+async def bench(args):
+    rng = random.Random(args.seed)
+    rows, tag = seed(args.users, args.points, args.badges, rng)
+    try:
+        if args.url:
+            client = httpx.AsyncClient(base_url=args.url, timeout=30)
+        else:
+            # Sem servidor o arranque da app (leaderboard em memória, réplicas) corre aqui
+            for handler in main.app.router.on_startup:
+                await handler()
+            if isinstance(leaderboard, MemoryLeaderboard):
+                await leaderboard.wait_loaded()
+            client = httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=main.app, raise_app_exceptions=False), base_url="http://bench", timeout=30
+            )
+        async with client:
+            results = await run(client, rows, args, rng)
+        if not args.url:
+            for handler in main.app.router.on_shutdown:
+                await handler()
+    finally:
+        cleanup(tag)
+        async with AsyncSessionLocal() as db:
+            await leaderboard.rebuild(db)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=20, help="alterações de pontos semeadas por utilizador")
+    parser.add_argument("--badges", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=20, help="segundos de medição")
+    parser.add_argument("--warmup", type=float, default=3, help="segundos de aquecimento antes de medir")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="pesos por endpoint, ex.: " + DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1, help="semente dos dados e da sequência de pedidos")
+    parser.add_argument("--url", help="servidor a testar; por omissão a app dentro do processo")
+    parser.add_argument("--output", help="ficheiro JSON de resultados (por omissão benchmarks/results/<commit>.json)")
+    parser.add_argument("--compare", help="ficheiro JSON de uma execução anterior")
+    args = parser.parse_args()
+
+    create_schema()
+    results = asyncio.run(bench(args))
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)["results"]
+    print_results(results, previous)
+
+    commit = git_commit()
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": commit,
+            "date": datetime.utcnow().isoformat(),
+            "database": engine.dialect.name,
+            "target": args.url or "asgi",
+            "args": vars(args),
+            "results": results,
+        }, f, indent=2)
+    print(f"✅ Resultados gravados em {output}")
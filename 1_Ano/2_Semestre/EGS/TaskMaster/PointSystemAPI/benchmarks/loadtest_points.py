@@ -0,0 +1,104 @@
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from database import ASYNC_DATABASE_URL
+from ledger import apply_points
+from models import User, Point
+
+# Teste de carga das atribuições de pontos: N escritores concorrentes dão pontos ao mesmo utilizador
+# (o pior caso de contenção) e no fim compara-se o total com o esperado.
+#   legacy -> lê o utilizador para Python, soma e faz commit (como o add_points fazia antes)
+#   atomic -> apply_points (UPDATE ... RETURNING + historial numa só instrução)
+#
+# Uso: python benchmarks/loadtest_points.py --writers 200 --awards 5
+
+
+async def award_legacy(Session, user_id):
+    async with Session() as db:
+        user = await db.get(User, user_id)
+        db.add(Point(user_id=user_id, points_change=1, message="loadtest"))
+        user.total_points += 1
+        await db.commit()
+
+
+async def award_atomic(Session, user_id):
+    async with Session() as db:
+        await apply_points(db, user_id, 1, "loadtest")
+        await db.commit()
+
+
+async def writer(Session, award, user_id, awards):
+    for _ in range(awards):
+        await award(Session, user_id)
+
+
+async def run(Session, award, user_id, writers, awards):
+    async with Session() as db:
+        await db.execute(delete(Point).where(Point.user_id == user_id))
+        await db.execute(update(User).where(User.id == user_id).values(total_points=0))
+        await db.commit()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(Session, award, user_id, awards) for _ in range(writers)))
+    elapsed = time.perf_counter() - start
+
+    async with Session() as db:
+        total_points = await db.scalar(select(User.total_points).where(User.id == user_id))
+
+    expected = writers * awards
+    return {
+        "expected": expected,
+        "total_points": total_points,
+        "lost_updates": expected - total_points,
+        "seconds": elapsed,
+        "awards_per_second": expected / elapsed,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--writers", type=int, default=200)
+    parser.add_argument("--awards", type=int, default=5, help="atribuições por escritor")
+    parser.add_argument("--pool-size", type=int, default=50)
+    args = parser.parse_args()
+
+    if ASYNC_DATABASE_URL.startswith("sqlite"):
+        engine = create_async_engine(ASYNC_DATABASE_URL)
+    else:
+        engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=args.pool_size, max_overflow=0, pool_timeout=300)
+    Session = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+    async with Session() as db:
+        user = User(name="loadtest", email=f"loadtest-{uuid.uuid4().hex}@loadtest.local", total_points=0)
+        db.add(user)
+        await db.commit()
+        user_id = user.id
+
+    try:
+        for name, award in (("legacy", award_legacy), ("atomic", award_atomic)):
+            result = await run(Session, award, user_id, args.writers, args.awards)
+            print(
+                f"{name:>6}: {result['total_points']}/{result['expected']} pontos "
+                f"({result['lost_updates']} perdidos), {result['seconds']:.2f}s, "
+                f"{result['awards_per_second']:.0f} atribuições/s"
+            )
+    finally:
+        async with Session() as db:
+            await db.execute(delete(Point).where(Point.user_id == user_id))
+            await db.execute(delete(User).where(User.id == user_id))
+            await db.commit()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
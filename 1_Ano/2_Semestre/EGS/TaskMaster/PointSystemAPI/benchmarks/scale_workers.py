@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import time
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+
+import loadtest_api
+from migrate import create_schema
+from database import AsyncSessionLocal, engine
+from leaderboard import leaderboard
+
+# Modo multi-worker: arranca a API com uvicorn --workers N (para cada N de --workers) contra a base de dados
+# de DATABASE_URL, com o canal de invalidação ligado (INVALIDATION_BACKEND=postgres), e para cada N:
+#   1. confirma que as caches dos vários processos ficam coerentes depois de uma escrita noutro processo:
+#      uma chave de API substituída deixa de ser aceite e o rank (leaderboard em memória) tem os pontos novos
+#      em todos os pedidos, qualquer que seja o worker que os recebe
+#   2. corre a mistura de pedidos do loadtest_api.py e mostra pedidos/s e p95, e o ganho em relação a 1 worker
+# O ganho só pode aproximar-se de N com pelo menos N cores livres (o cliente de carga também gasta CPU).
+#
+# Uso: python benchmarks/scale_workers.py --workers 1,2 --duration 20 --concurrency 50
+
+COHERENCE_REQUESTS = 40
+PROPAGATION_SECONDS = 0.5
+
+
+def start_server(workers, port):
+    env = dict(os.environ)
+    if engine.dialect.name == "postgresql":
+        env.setdefault("INVALIDATION_BACKEND", "postgres")
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')),
+        env=env,
+    )
+
+
+async def wait_ready(client, server, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit("O servidor terminou durante o arranque")
+        try:
+            if (await client.get("/v1/stream/stats")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise SystemExit("O servidor não arrancou a tempo")
+
+
+async def check_coherence(client, user_id, api_key):
+    problems = []
+
+    # Todos os workers ficam com a chave na cache
+    await asyncio.gather(*(client.get("/v1/validate-api-key", params={"api_key": api_key}) for _ in range(COHERENCE_REQUESTS)))
+    new_key = (await client.post("/v1/generate-api-key", params={"user_id": user_id})).json()["api_key"]
+    await asyncio.sleep(PROPAGATION_SECONDS)
+    statuses = [
+        response.status_code for response in await asyncio.gather(
+            *(client.get("/v1/validate-api-key", params={"api_key": api_key}) for _ in range(COHERENCE_REQUESTS))
+        )
+    ]
+    if any(status != 401 for status in statuses):
+        problems.append(f"chave antiga ainda aceite em {sum(status != 401 for status in statuses)} de {len(statuses)} pedidos")
+
+    total_points = (await client.post(f"/v1/users/{user_id}/points/", params={"points": 7, "message": "scale"})).json()["total_points"]
+    await asyncio.sleep(PROPAGATION_SECONDS)
+    ranks = await asyncio.gather(*(client.get(f"/v1/users/{user_id}/rank") for _ in range(COHERENCE_REQUESTS)))
+    stale = [r for r in ranks if r.json().get("total_points") != total_points]
+    if stale:
+        problems.append(f"rank com pontos antigos em {len(stale)} de {len(ranks)} pedidos")
+
+    return new_key, problems
+
+
+async def bench(args):
+    rng = random.Random(args.seed)
+    rows, tag = loadtest_api.seed(args.users, args.points, args.badges, rng)
+    results = {}
+    try:
+        for workers in [int(n) for n in args.workers.split(",")]:
+            server = start_server(workers, args.port)
+            try:
+                async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=30) as client:
+                    await wait_ready(client, server)
+                    user_id, api_key = rows[0]
+                    new_key, problems = await check_coherence(client, user_id, api_key)
+                    rows[0] = (user_id, new_key)
+                    for problem in problems:
+                        print(f"❌ {workers} worker(s): {problem}")
+                    if not problems:
+                        print(f"✅ {workers} worker(s): caches coerentes depois de escritas noutro processo")
+                    results[workers] = (await loadtest_api.run(client, rows, args, rng))["total"]
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        loadtest_api.cleanup(tag)
+        async with AsyncSessionLocal() as db:
+            await leaderboard.rebuild(db)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2", help="números de workers a comparar, ex.: 1,2,4")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--points", type=int, default=20)
+    parser.add_argument("--badges", type=int, default=5)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--mix", default=loadtest_api.DEFAULT_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    create_schema()
+    results = asyncio.run(bench(args))
+
+    base = results.get(min(results))
+    print(f"cores disponíveis: {os.cpu_count()}")
+    print(f"{'workers':>8} {'pedidos/s':>10} {'p95 ms':>8} {'erros':>6} {'ganho':>6}")
+    for workers, r in results.items():
+        print(f"{workers:8d} {r['rps']:10.1f} {r['p95_ms'] or 0:8.1f} {r['errors']:6d} {r['rps'] / base['rps']:5.2f}x")
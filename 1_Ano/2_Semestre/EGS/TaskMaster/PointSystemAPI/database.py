@@ -1,15 +1,171 @@
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from dotenv import load_dotenv
 
+import metrics
+
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
-engine = create_engine(DATABASE_URL)
+# Configuração do pool de ligações (não se aplica a SQLite). Os valores por omissão são os do SQLAlchemy;
+# no deployment.yaml estão os usados no cluster (pod com 128Mi / 500m, por isso poucas ligações).
+#   DB_POOL_SIZE / DB_MAX_OVERFLOW  -> ligações mantidas abertas / extra em picos (fechadas ao devolver)
+#   DB_POOL_TIMEOUT                 -> segundos à espera de uma ligação livre antes de falhar
+#   DB_POOL_RECYCLE                 -> segundos até uma ligação ser substituída (-1 = nunca)
+#   DB_POOL_PRE_PING                -> testa a ligação antes de a usar (ex.: depois de o Postgres reiniciar)
+#   DB_STATEMENT_TIMEOUT_MS         -> statement_timeout do Postgres para cada ligação (0 = sem limite)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+
+# Caches de instruções: o SQL compilado pelo SQLAlchemy por estrutura de consulta (DB_QUERY_CACHE_SIZE, por motor)
+# e os prepared statements do asyncpg no servidor (DB_PREPARED_STATEMENT_CACHE_SIZE, por ligação; 0 desliga).
+# As consultas mais frequentes são construídas uma só vez (ver API_KEY_LOOKUP, HISTORY_*, RANKING_*), por isso
+# cada pedido reutiliza o mesmo SQL compilado e o mesmo prepared statement.
+DB_QUERY_CACHE_SIZE = int(os.getenv("DB_QUERY_CACHE_SIZE", "500"))
+DB_PREPARED_STATEMENT_CACHE_SIZE = os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE")
+
+# Métricas dos pools (GET /metrics), por motor: "sync" (migrate.py, scripts) e "async" (endpoints)
+pool_checkout_seconds = metrics.histogram(
+    "db_pool_checkout_seconds", "Tempo à espera de uma ligação do pool (inclui abrir uma nova)"
+)
+pool_timeouts = metrics.counter("db_pool_checkout_timeouts_total", "Checkouts que falharam por DB_POOL_TIMEOUT")
+pool_connections_opened = metrics.counter("db_pool_connections_opened_total", "Ligações abertas à base de dados")
+pool_connections_closed = metrics.counter("db_pool_connections_closed_total", "Ligações fechadas (overflow, recycle, erros)")
+pool_connections_invalidated = metrics.counter("db_pool_connections_invalidated_total", "Ligações descartadas por erro ou pre-ping")
+
+
+# Pool que mede o tempo de cada checkout: é aí que se nota o pool esgotado
+def timed_pool(base, name: str):
+    class TimedPool(base):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                return super().connect()
+            except exc.TimeoutError:
+                pool_timeouts.inc(engine=name)
+                raise
+            finally:
+                pool_checkout_seconds.observe(time.perf_counter() - start, engine=name)
+
+    return TimedPool
+
+
+def pool_options(url: str, pool_class, name: str):
+    if url.startswith("sqlite"):
+        return {}
+    options = {
+        "poolclass": timed_pool(pool_class, name),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    if DB_STATEMENT_TIMEOUT_MS and url.startswith("postgresql"):
+        if url.startswith("postgresql+asyncpg"):
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+engines = {}
+
+
+def instrument(name: str, sync_engine):
+    engines[name] = sync_engine
+    event.listen(sync_engine, "connect", lambda *args: pool_connections_opened.inc(engine=name))
+    event.listen(sync_engine, "close", lambda *args: pool_connections_closed.inc(engine=name))
+    event.listen(sync_engine, "invalidate", lambda *args: pool_connections_invalidated.inc(engine=name))
+
+
+def pool_gauge(read):
+    # Lê o pool actual de cada motor (o pool é substituído em engine.dispose())
+    return lambda: [
+        ({"engine": name}, read(sync_engine.pool))
+        for name, sync_engine in engines.items()
+        if isinstance(sync_engine.pool, QueuePool)
+    ]
+
+
+metrics.gauge("db_pool_size", "Ligações permanentes do pool (DB_POOL_SIZE)", pool_gauge(lambda pool: pool.size()))
+metrics.gauge("db_pool_checked_out", "Ligações em uso", pool_gauge(lambda pool: pool.checkedout()))
+metrics.gauge("db_pool_checked_in", "Ligações livres no pool", pool_gauge(lambda pool: pool.checkedin()))
+metrics.gauge("db_pool_overflow", "Ligações acima de DB_POOL_SIZE (negativo enquanto o pool não está cheio)", pool_gauge(lambda pool: pool.overflow()))
+
+
+engine = create_engine(DATABASE_URL, query_cache_size=DB_QUERY_CACHE_SIZE, **pool_options(DATABASE_URL, QueuePool, "sync"))
+instrument("sync", engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+# Motor assíncrono usado pelos endpoints da API (asyncpg em Postgres, aiosqlite em SQLite).
+# Por omissão deriva do DATABASE_URL trocando o driver; ASYNC_DATABASE_URL permite indicá-lo à mão.
+def async_url(url: str) -> str:
+    if url.startswith("postgresql"):
+        return "postgresql+asyncpg" + url[url.index(":"):]
+    if url.startswith("sqlite"):
+        return "sqlite+aiosqlite" + url[url.index(":"):]
+    return url
+
+def with_statement_cache(url: str) -> str:
+    if DB_PREPARED_STATEMENT_CACHE_SIZE is None or not url.startswith("postgresql+asyncpg"):
+        return url
+    return make_url(url).update_query_dict(
+        {"prepared_statement_cache_size": DB_PREPARED_STATEMENT_CACHE_SIZE}
+    ).render_as_string(hide_password=False)
+
+ASYNC_DATABASE_URL = with_statement_cache(os.getenv("ASYNC_DATABASE_URL") or async_url(DATABASE_URL))
+
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    query_cache_size=DB_QUERY_CACHE_SIZE,
+    **pool_options(ASYNC_DATABASE_URL, AsyncAdaptedQueuePool, "async")
+)
+instrument("async", async_engine.sync_engine)
+
+# expire_on_commit=False para os objectos continuarem legíveis depois do commit sem nova ida à base de dados
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+# Réplicas de leitura (opcional): DATABASE_REPLICA_URLS com os URLs separados por vírgulas, no mesmo formato
+# do DATABASE_URL. Só são usadas pelos endpoints GET através de replicas.py; as escritas vão sempre para o primário.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+replica_engines = []
+for i, url in enumerate(DATABASE_REPLICA_URLS):
+    url = with_statement_cache(async_url(url))
+    replica_engine = create_async_engine(
+        url, query_cache_size=DB_QUERY_CACHE_SIZE, **pool_options(url, AsyncAdaptedQueuePool, f"replica{i}")
+    )
+    instrument(f"replica{i}", replica_engine.sync_engine)
+    replica_engines.append(replica_engine)
+
+Base = declarative_base()
+
+
+# Regista uma função a correr só depois do commit da sessão (ex.: actualizar estruturas em memória).
+# Se a transação fizer rollback, as funções pendentes são descartadas. Funciona com Session e AsyncSession.
+def on_commit(db, fn):
+    db.info.setdefault("after_commit_hooks", []).append(fn)
+
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit_hooks(session):
+    hooks = session.info.pop("after_commit_hooks", [])
+    for fn in hooks:
+        fn()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_after_commit_hooks(session):
+    session.info.pop("after_commit_hooks", None)
\ No newline at end of file
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import os
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import invalidation
+from leaderboard import leaderboard, BULK_THRESHOLD
+
+# Eventos de alteração de pontos e badges enviados por Server-Sent Events (GET /v1/stream).
+# Em vez de cada cliente voltar a pedir o ranking inteiro para notar uma alteração, recebe só o que mudou:
+#   {"type": "points", "user_id": 1, "total_points": 120, "rank": 3}            (+ "badge_id" se o badge mudou)
+#   {"type": "badge", "user_id": 1, "badge_id": 2}                              (atribuição de badges)
+#   {"type": "reset"}                                                           (muitas alterações: voltar a pedir tudo)
+#
+# Os eventos são publicados depois do commit e distribuídos por um hub em memória: cada cliente tem uma fila limitada.
+# Um cliente lento não atrasa os outros nem quem publica: se a fila encher, é esvaziada e recebe um "reset".
+# Clientes parados não fazem pedidos à base de dados; só recebem um comentário de keep-alive periódico.
+# O hub é por processo: os eventos publicados são também enviados aos outros workers pelo canal de invalidação
+# (invalidation.py), que os entregam aos clientes ligados a eles.
+
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "100"))
+STREAM_KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", "15"))
+
+RESET = {"type": "reset"}
+
+
+class Subscriber:
+
+    def __init__(self, user_id=None):
+        self.user_id = user_id  # Se indicado, só recebe eventos deste utilizador
+        self.queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.dropped = 0
+
+    def offer(self, event):
+        if self.user_id is not None and event.get("user_id", self.user_id) != self.user_id:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # O cliente não está a acompanhar: descarta o que tem pendente e pede-lhe para recarregar tudo
+            self.dropped += self.queue.qsize()
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(RESET)
+
+
+class Hub:
+
+    def __init__(self):
+        self._subscribers = set()
+
+    def subscribe(self, user_id=None):
+        subscriber = Subscriber(user_id)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def publish(self, event):
+        self.deliver(event)
+        invalidation.publish("event", event)
+
+    def deliver(self, event):
+        # Só aos clientes deste processo
+        for subscriber in list(self._subscribers):
+            subscriber.offer(event)
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "pending": sum(s.queue.qsize() for s in self._subscribers),
+            "dropped": sum(s.dropped for s in self._subscribers),
+        }
+
+
+hub = Hub()
+
+
+def deliver_remote(events):
+    for event in events:
+        hub.deliver(event)
+
+
+invalidation.subscribe("event", deliver_remote)
+invalidation.subscribe("resync", lambda _: hub.deliver(RESET))
+
+
+# Publica a alteração de pontos de um utilizador (chamar depois do commit). badge=(mudou, badge_id) de update_user_badge.
+async def publish_points(db: AsyncSession, user_id: int, total_points: int, badge=None):
+    ranked = await leaderboard.rank(db, user_id)
+    event = {"type": "points", "user_id": user_id, "total_points": total_points, "rank": ranked[0] if ranked else None}
+    if badge is not None and badge[0]:
+        event["badge_id"] = badge[1]
+    hub.publish(event)
+
+
+# Alterações em massa: até BULK_THRESHOLD utilizadores um evento por cada, acima disso um só "reset"
+async def publish_points_many(db: AsyncSession, totals):
+    if len(totals) > BULK_THRESHOLD:
+        hub.publish(RESET)
+        return
+    ranks = await leaderboard.ranks(db, list(totals))
+    for user_id, total_points in totals.items():
+        hub.publish({"type": "points", "user_id": user_id, "total_points": total_points, "rank": ranks.get(user_id)})
+
+
+def publish_badges(changed):
+    # changed: [(user_id, name, badge_id), ...] de assign_all_badges
+    if len(changed) > BULK_THRESHOLD:
+        hub.publish(RESET)
+        return
+    for user_id, _, badge_id in changed:
+        hub.publish({"type": "badge", "user_id": user_id, "badge_id": badge_id})
+
+
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n"
+
+
+# Corpo da resposta SSE para um cliente; termina quando o cliente desliga (o Starlette cancela o gerador)
+async def stream(user_id=None):
+    subscriber = hub.subscribe(user_id)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(subscriber.queue.get(), timeout=STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield format_event(event)
+    finally:
+        hub.unsubscribe(subscriber)
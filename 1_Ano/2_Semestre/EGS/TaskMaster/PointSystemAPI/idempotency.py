@@ -0,0 +1,129 @@
+import asyncio
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from sqlalchemy import select, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal, on_commit
+from models import IdempotencyKey
+
+# Pedidos com o header Idempotency-Key (ex.: completar uma quest) podem ser repetidos pelo cliente
+# (timeouts, duplo toque) sem serem executados duas vezes.
+#
+# A chave é registada na base de dados na mesma transação do pedido, antes de qualquer alteração:
+#   - se já existe com resposta guardada -> devolve essa resposta
+#   - se outro pedido com a mesma chave está a meio -> em Postgres o INSERT espera que ele termine
+#     (e depois devolve a resposta dele); se ainda não houver resposta -> 409
+#   - se o pedido falhar, o rollback apaga a chave e uma nova tentativa corre normalmente
+# As respostas guardadas ficam também numa cache LRU em memória, para as repetições nem irem à base de dados.
+#
+# Para apagar chaves antigas: python idempotency.py purge [horas]
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Tamanho máximo do header Idempotency-Key, o da coluna idempotency_keys.key (validado no endpoint, com 422)
+MAX_KEY_LENGTH = IdempotencyKey.__table__.c.key.type.length
+DEFAULT_PURGE_HOURS = 24
+
+
+class ResponseCache:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # chave -> (pedido, status_code, corpo)
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+responses = ResponseCache(IDEMPOTENCY_CACHE_SIZE)
+
+
+def replay(request: str, entry):
+    stored_request, status_code, body = entry
+    if stored_request != request:
+        raise HTTPException(status_code=422, detail="Idempotency-Key já usada noutro pedido.")
+    return JSONResponse(content=json.loads(body), status_code=status_code, headers={"Idempotent-Replay": "true"})
+
+
+# Chamar no início do pedido. Devolve a resposta a repetir, ou None se o pedido deve ser executado
+# (nesse caso a chave fica reservada na transação actual e deve ser chamado remember() antes do commit).
+async def begin(db: AsyncSession, key: str, request: str):
+    entry = responses.get(key)
+    if entry is not None:
+        return replay(request, entry)
+
+    if db.get_bind().dialect.name == "postgresql":
+        insert = postgresql.insert(IdempotencyKey)
+    else:
+        insert = sqlite.insert(IdempotencyKey)
+    reserved = (await db.execute(
+        insert.values(key=key, request=request)
+        .on_conflict_do_nothing(index_elements=[IdempotencyKey.key])
+        .returning(IdempotencyKey.key)
+    )).first()
+    if reserved is not None:
+        return None
+
+    row = (await db.execute(
+        select(IdempotencyKey.request, IdempotencyKey.status_code, IdempotencyKey.response)
+        .where(IdempotencyKey.key == key)
+    )).first()
+    if row.status_code is None:
+        raise HTTPException(status_code=409, detail="Já existe um pedido em curso com esta Idempotency-Key.")
+    entry = (row.request, row.status_code, row.response)
+    responses.put(key, entry)
+    return replay(request, entry)
+
+
+# Guarda a resposta do pedido na transação actual; fica em cache depois do commit
+async def remember(db: AsyncSession, key: str, request: str, content, status_code: int = 200):
+    body = json.dumps(content)
+    await db.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.key == key)
+        .values(status_code=status_code, response=body)
+    )
+    on_commit(db, lambda: responses.put(key, (request, status_code, body)))
+
+
+async def purge(db: AsyncSession, hours: int = DEFAULT_PURGE_HOURS):
+    cutoff = datetime.utcnow() - timedelta(hours=hours)
+    result = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))
+    await db.commit()
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    if not sys.argv[1:] or sys.argv[1] != "purge":
+        print("Uso: python idempotency.py purge [horas]")
+        sys.exit(1)
+
+    hours = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PURGE_HOURS
+
+    async def run_purge():
+        async with AsyncSessionLocal() as db:
+            return await purge(db, hours)
+
+    removed = asyncio.run(run_purge())
+
+    print(f"✅ {removed} chaves de idempotência removidas.")
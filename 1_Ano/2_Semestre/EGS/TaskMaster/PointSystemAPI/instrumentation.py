@@ -0,0 +1,152 @@
+import contextvars
+import logging
+import os
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+import metrics
+from database import engines
+
+# Tempos por endpoint, para saber se um pedido lento está à espera da base de dados ou a gastar CPU no Python
+# (hidratação do ORM, serialização).
+#
+# O RequestTimingMiddleware (ASGI) mede cada pedido e os eventos before/after_cursor_execute de todos os motores
+# (database.engines: primário, assíncrono e réplicas) somam ao pedido corrente o tempo na base de dados, o número
+# de instruções e as linhas devolvidas. Por endpoint (o caminho da rota, ex.: /v1/users/{user_id}) exporta-se em
+# GET /metrics:
+#   http_request_duration_seconds      tempo total do pedido
+#   http_request_db_seconds            tempo à espera da base de dados
+#   http_request_db_statements         instruções executadas
+#   http_request_db_rows               linhas devolvidas ou alteradas
+#
+# SERVER_TIMING=1 acrescenta às respostas o header Server-Timing (db, serialização e resto do Python),
+# que aparece no separador Network do browser.
+# Um pedido com mais de QUERY_COUNT_WARNING instruções é registado no log com as que mais se repetem:
+# é normalmente um N+1 (uma consulta por cada linha de uma lista).
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0").lower() in ("1", "true", "yes")
+QUERY_COUNT_WARNING = int(os.getenv("QUERY_COUNT_WARNING", "20"))
+
+# Buckets para contagens (instruções e linhas por pedido)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000, 10000, 100000)
+
+logger = logging.getLogger(__name__)
+
+request_duration = metrics.histogram("http_request_duration_seconds", "Tempo total do pedido por rota")
+request_db_time = metrics.histogram("http_request_db_seconds", "Tempo à espera da base de dados por pedido")
+request_statements = metrics.histogram(
+    "http_request_db_statements", "Instruções SQL executadas por pedido", COUNT_BUCKETS
+)
+request_rows = metrics.histogram("http_request_db_rows", "Linhas devolvidas ou alteradas por pedido", COUNT_BUCKETS)
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.sql = Counter()
+
+
+# Estatísticas do pedido em curso (None fora de um pedido, ex.: tarefas em fundo e scripts).
+# Com o motor assíncrono os eventos correm num greenlet que herda o contexto da tarefa do pedido.
+current = contextvars.ContextVar("request_stats", default=None)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current.get() is not None and context is not None:
+        context.request_query_start = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current.get()
+    start = getattr(context, "request_query_start", None)
+    if stats is None or start is None:
+        return
+    stats.db_time += time.perf_counter() - start
+    stats.statements += 1
+    stats.sql[statement] += 1
+    # Os adaptadores asyncpg e aiosqlite já leram as linhas todas para _rows; nos outros drivers o rowcount
+    # dá as linhas alteradas (e, no psycopg2, também as de um SELECT)
+    rows = getattr(cursor, "_rows", None)
+    stats.rows += len(rows) if rows is not None else max(cursor.rowcount, 0)
+
+
+def instrument_engine(sync_engine):
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+
+
+for sync_engine in engines.values():
+    instrument_engine(sync_engine)
+
+
+# Tempo de serialização de uma resposta (serialization.timed_dumps: FastJSONResponse e response_cache.py)
+def add_serialize_time(seconds: float):
+    stats = current.get()
+    if stats is not None:
+        stats.serialize_time += seconds
+
+
+def server_timing(stats: RequestStats, total: float):
+    app_time = max(total - stats.db_time - stats.serialize_time, 0.0)
+    return (
+        f'db;dur={stats.db_time * 1000:.1f};desc="{stats.statements} queries", '
+        f'serialize;dur={stats.serialize_time * 1000:.1f}, '
+        f'app;dur={app_time * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}'
+    ).encode()
+
+
+class RequestTimingMiddleware:
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        stats = RequestStats()
+        token = current.set(stats)
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                if SERVER_TIMING:
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(stats, time.perf_counter() - start)))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
+            self.record(scope, stats, time.perf_counter() - start, status["code"])
+
+    def record(self, scope, stats: RequestStats, total: float, status_code: int):
+        # Caminho da rota (e não o pedido) para não criar uma série por cada id
+        route = scope.get("route")
+        path = getattr(route, "path", None) or "unmatched"
+        method = scope["method"]
+
+        request_duration.observe(total, route=path, method=method, status=status_code)
+        request_db_time.observe(stats.db_time, route=path, method=method)
+        request_statements.observe(stats.statements, route=path, method=method)
+        request_rows.observe(stats.rows, route=path, method=method)
+
+        if stats.statements > QUERY_COUNT_WARNING:
+            repeated = "; ".join(
+                f"{count}x {' '.join(statement.split())[:120]}" for statement, count in stats.sql.most_common(3)
+            )
+            logger.warning(
+                "%s %s executou %d instruções SQL (%.1f ms na base de dados), possível N+1: %s",
+                method, scope["path"], stats.statements, stats.db_time * 1000, repeated
+            )
@@ -0,0 +1,222 @@
+import asyncio
+import inspect
+import json
+import os
+import secrets
+
+from sqlalchemy import make_url
+
+import metrics
+from database import ASYNC_DATABASE_URL
+
+# Canal de invalidação entre processos, para correr vários workers (WEB_CONCURRENCY) e várias réplicas do pod
+# sem que as caches e estruturas em memória de cada processo fiquem desactualizadas.
+#
+# Depois do commit, quem altera algo que outros processos têm em memória chama publish(tipo, dados); os outros
+# processos recebem a mensagem e aplicam a mesma alteração localmente. Cada módulo regista o que faz com as
+# mensagens do seu tipo com subscribe(tipo, handler), e o handler recebe a lista dos dados de uma mensagem:
+#   api_key              hashes de chaves substituídas ou removidas          (api_keys.py)
+#   badges               thresholds dos badges alterados                     (badges.py)
+#   cache                versões da cache de respostas em memória            (response_cache.py)
+#   leaderboard          utilizadores cujos pontos mudaram (relidos da base de dados)   (leaderboard.py, memory)
+#   leaderboard_rebuild  reconstrução completa do leaderboard                (leaderboard.py, memory)
+#   event                eventos para os clientes do stream SSE ligados a outros workers (events.py)
+#   write                janela read-your-writes das réplicas                (replicas.py)
+# A cache de respostas idempotentes (idempotency.py) não precisa: uma resposta guardada nunca muda.
+#
+# INVALIDATION_BACKEND escolhe o transporte:
+#   none     -> nada é enviado (por omissão; só correcto com um único processo)
+#   postgres -> LISTEN/NOTIFY do Postgres no canal INVALIDATION_CHANNEL, numa ligação asyncpg dedicada por processo
+#
+# As mensagens são juntadas num só NOTIFY enquanto a ligação está ocupada, por isso com muitas escritas o custo
+# não cresce com o número de pedidos. Chegam aos outros processos poucos milissegundos depois do commit.
+# Se a ligação cair, ao voltar cada processo corre os handlers de "resync" (esvazia as caches e reconstrói o
+# leaderboard), porque pode ter perdido mensagens entretanto.
+
+INVALIDATION_BACKEND = os.getenv("INVALIDATION_BACKEND", "none")
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "pointsystem_invalidation")
+INVALIDATION_RECONNECT_SECONDS = float(os.getenv("INVALIDATION_RECONNECT_SECONDS", "2"))
+
+# O payload de um NOTIFY está limitado a 8000 bytes
+MAX_PAYLOAD = 7500
+
+sent = metrics.counter("invalidation_messages_sent_total", "Mensagens de invalidação enviadas por tipo")
+received = metrics.counter("invalidation_messages_received_total", "Mensagens de invalidação recebidas por tipo")
+resyncs = metrics.counter("invalidation_resyncs_total", "Ressincronizações completas depois de perder a ligação")
+handler_errors = metrics.counter("invalidation_handler_errors_total", "Erros ao aplicar mensagens recebidas por tipo")
+
+
+# Ligação asyncpg a partir do ASYNC_DATABASE_URL (sem o driver do SQLAlchemy nem as opções que só ele conhece)
+def listen_dsn():
+    url = make_url(ASYNC_DATABASE_URL)
+    query = {key: value for key, value in url.query.items() if key != "prepared_statement_cache_size"}
+    return url.set(drivername="postgresql", query=query).render_as_string(hide_password=False)
+
+
+class Channel:
+
+    def __init__(self, backend: str, channel: str):
+        self.backend = backend
+        self.channel = channel
+        self.origin = secrets.token_hex(8)  # Identifica este processo, para ignorar as próprias mensagens
+        self.handlers = {}
+        self.connected = False
+        self._outbox = None
+        self._inbox = None
+        self._tasks = []
+
+    def subscribe(self, kind: str, handler):
+        self.handlers.setdefault(kind, []).append(handler)
+
+    # Não bloqueia: a mensagem é enviada por uma tarefa em fundo. Tipos sem handlers não são enviados,
+    # porque os outros processos têm a mesma configuração e também não os teriam.
+    def publish(self, kind: str, data=None):
+        if self._outbox is None or kind not in self.handlers:
+            return
+        self._outbox.put_nowait((kind, data))
+
+    async def start(self):
+        if self.backend == "none" or self._tasks:
+            return
+        if self.backend != "postgres":
+            raise RuntimeError(f"INVALIDATION_BACKEND inválido: {self.backend}")
+        if not ASYNC_DATABASE_URL.startswith("postgresql"):
+            raise RuntimeError("INVALIDATION_BACKEND=postgres requer uma base de dados Postgres")
+        self._outbox = asyncio.Queue()
+        self._inbox = asyncio.Queue()
+        ready = asyncio.get_running_loop().create_future()
+        self._tasks = [asyncio.create_task(self._run(ready)), asyncio.create_task(self._dispatch())]
+        # Só continua o arranque (ex.: carregar o leaderboard) depois de estar a ouvir, para não perder alterações
+        await ready
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._outbox = None
+        self._inbox = None
+        self.connected = False
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get("origin") != self.origin:
+            self._inbox.put_nowait(message["messages"])
+
+    async def _run(self, ready):
+        import asyncpg
+
+        missed = False
+        pending = []
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(listen_dsn())
+                lost = asyncio.get_running_loop().create_future()
+                connection.add_termination_listener(lambda _: lost.done() or lost.set_result(None))
+                await connection.add_listener(self.channel, self._on_notify)
+                self.connected = True
+                if not ready.done():
+                    ready.set_result(None)
+                if missed:
+                    # Pode ter perdido mensagens enquanto estava desligado
+                    resyncs.inc()
+                    self._inbox.put_nowait([["resync", None]])
+                    missed = False
+                while True:
+                    if not pending:
+                        # Espera por mensagens para enviar, ou que a ligação caia (e com ela o LISTEN)
+                        get = asyncio.ensure_future(self._outbox.get())
+                        await asyncio.wait({get, lost}, return_when=asyncio.FIRST_COMPLETED)
+                        if not get.done():
+                            get.cancel()
+                            raise ConnectionError("Ligação do canal de invalidação perdida")
+                        pending = [get.result()]
+                    pending.extend(self._drain())
+                    for payload in self._payloads(pending):
+                        await connection.execute("SELECT pg_notify($1, $2)", self.channel, payload)
+                    for kind, _ in pending:
+                        sent.inc(kind=kind)
+                    pending = []
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # As mensagens por enviar ficam em pending e seguem quando a ligação voltar
+                self.connected = False
+                missed = True
+                if not ready.done():
+                    ready.set_result(None)
+                await asyncio.sleep(INVALIDATION_RECONNECT_SECONDS)
+            finally:
+                if connection is not None:
+                    connection.terminate()
+
+    def _drain(self):
+        messages = []
+        while not self._outbox.empty():
+            messages.append(self._outbox.get_nowait())
+        return messages
+
+    def _payloads(self, messages):
+        # Junta as mensagens em payloads abaixo do limite do NOTIFY
+        batch = []
+        size = 0
+        for kind, data in messages:
+            encoded = json.dumps([kind, data], separators=(",", ":"))
+            if len(encoded) > MAX_PAYLOAD:
+                # Não cabe num NOTIFY: os outros processos esvaziam tudo o que têm em memória
+                encoded = '["resync",null]'
+            if batch and size + len(encoded) > MAX_PAYLOAD:
+                yield self._encode(batch)
+                batch, size = [], 0
+            batch.append(encoded)
+            size += len(encoded) + 1
+        if batch:
+            yield self._encode(batch)
+
+    def _encode(self, batch):
+        return '{"origin":"' + self.origin + '","messages":[' + ",".join(batch) + "]}"
+
+    async def _dispatch(self):
+        while True:
+            messages = await self._inbox.get()
+            by_kind = {}
+            for kind, data in messages:
+                by_kind.setdefault(kind, []).append(data)
+            for kind, items in by_kind.items():
+                received.inc(len(items), kind=kind)
+                for handler in self.handlers.get(kind, []):
+                    try:
+                        result = handler(items)
+                        if inspect.isawaitable(result):
+                            await result
+                    except Exception:
+                        # Um handler com erro não pode parar a recepção das mensagens seguintes
+                        handler_errors.inc(kind=kind)
+
+
+channel = Channel(INVALIDATION_BACKEND, INVALIDATION_CHANNEL)
+
+metrics.gauge(
+    "invalidation_connected", "1 se o processo está a ouvir o canal de invalidação",
+    lambda: [({"backend": channel.backend}, int(channel.connected))]
+)
+
+
+def subscribe(kind: str, handler):
+    channel.subscribe(kind, handler)
+
+
+def publish(kind: str, data=None):
+    channel.publish(kind, data)
+
+
+async def start():
+    await channel.start()
+
+
+async def stop():
+    await channel.stop()
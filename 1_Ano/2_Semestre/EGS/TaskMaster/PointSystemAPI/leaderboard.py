@@ -0,0 +1,398 @@
+import asyncio
+import os
+import sys
+import threading
+from bisect import bisect_left, insort
+
+from sqlalchemy import select, update, delete, insert, func, text, bindparam
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+import invalidation
+from database import AsyncSessionLocal, on_commit
+from models import User, UserRank
+
+# Leaderboard mantido incrementalmente nas escritas (add_points, remove_points, complete_quest, ...),
+# para que ler o top-N e o rank de um utilizador não obrigue a recalcular o ranking inteiro.
+#
+# O ranking é de competição ("1224"): utilizadores com os mesmos pontos partilham o rank
+# e o seguinte salta as posições ocupadas pelo empate. Dentro de um empate a ordem é pelo id.
+#
+# Existem dois backends, escolhidos pela variável de ambiente LEADERBOARD_BACKEND:
+#   memory -> lista ordenada em memória do processo (por omissão). Com vários workers, cada alteração é
+#             anunciada aos outros pelo canal de invalidação (invalidation.py), que relêem esses utilizadores.
+#             No arranque é carregado em fundo; até acabar, rank e top são calculados na base de dados
+#   table  -> tabela materializada user_ranks na base de dados. Só para poucas escritas de pontos: cada escrita
+#             espera por um lock global até ao commit e pode reescrever o rank de muitos utilizadores (ver TableLeaderboard)
+#
+# Para reconstruir do zero: python leaderboard.py rebuild
+
+# A partir de quantas alterações numa só escrita compensa recalcular tudo em vez de actualizar uma a uma
+BULK_THRESHOLD = 64
+
+# Espera entre tentativas de carregar o leaderboard em memória no arranque, se a base de dados falhar
+LOAD_RETRY_SECONDS = 2
+# Linhas lidas de cada vez no carregamento em fundo; entre lotes o processo vai respondendo a pedidos
+LOAD_BATCH_SIZE = 5000
+
+# Enquanto o leaderboard em memória não está carregado, o rank é calculado na base de dados
+RANKED = aliased(User)
+RANK_OF_POINTS = select(func.count()).select_from(RANKED).where(RANKED.total_points > bindparam("total_points"))
+RANKS_OF_USERS = select(
+    User.id,
+    select(func.count()).select_from(RANKED).where(RANKED.total_points > User.total_points).scalar_subquery() + 1,
+).where(User.id.in_(bindparam("user_ids", expanding=True)))
+
+
+class MemoryLeaderboard:
+    # Lista ordenada de chaves (-total_points, user_id) + dicionário user_id -> total_points.
+    # Procuras são O(log n) por bisect; as alterações só são aplicadas depois do commit.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []
+        self._points = {}
+        self._generation = 0  # Conta as alterações feitas por este processo
+        self._loaded = False
+        self._touched = None  # Utilizadores alterados durante o carregamento em fundo
+        self._task = None
+
+    async def rebuild(self, db: AsyncSession):
+        rows = (await db.execute(select(User.id, User.total_points))).all()
+        self._install(rows)
+
+    # Com as linhas já ordenadas pela base de dados (pelo índice de total_points) o sort() é linear
+    def _install(self, rows):
+        with self._lock:
+            self._points = {user_id: total_points for user_id, total_points in rows}
+            self._keys = [(-total_points, user_id) for user_id, total_points in rows]
+            self._keys.sort()
+            self._loaded = True
+
+    # Carrega o leaderboard em fundo: o processo começa logo a responder e, até acabar, rank e top vão à base de dados
+    def start_loading(self):
+        if self._task is None and not self._loaded:
+            self._task = asyncio.create_task(self._load())
+
+    async def wait_loaded(self):
+        if self._task is not None:
+            await asyncio.shield(self._task)
+
+    async def stop_loading(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _load(self):
+        self._touched = set()
+        while True:
+            try:
+                rows = []
+                async with AsyncSessionLocal() as db:
+                    result = await db.stream(
+                        select(User.id, User.total_points)
+                        .order_by(User.total_points.desc(), User.id)
+                        .execution_options(yield_per=LOAD_BATCH_SIZE)
+                    )
+                    async for batch in result.partitions():
+                        rows.extend(batch)
+                break
+            except Exception:
+                await asyncio.sleep(LOAD_RETRY_SECONDS)
+        self._install(rows)
+        # Quem mudou durante a leitura pode ter ficado com os pontos de antes e é relido;
+        # as alterações a partir daqui já são aplicadas ao leaderboard carregado
+        user_ids, self._touched = self._touched, None
+        if user_ids:
+            await self.reload(user_ids)
+        self._task = None
+
+    async def update(self, db: AsyncSession, user_id: int, total_points: int):
+        on_commit(db, lambda: self._committed({user_id: total_points}))
+
+    async def update_many(self, db: AsyncSession, totals):
+        # totals: {user_id: total_points}; usado pelas atribuições em massa
+        totals = dict(totals)
+        on_commit(db, lambda: self._committed(totals))
+
+    async def remove(self, db: AsyncSession, user_id: int):
+        on_commit(db, lambda: self._committed({}, [user_id]))
+
+    def _committed(self, totals, removed=()):
+        self._generation += 1
+        self._set_many(totals)
+        for user_id in removed:
+            self._discard(user_id)
+        user_ids = list(totals) + list(removed)
+        if self._touched is not None:
+            self._touched.update(user_ids)
+        if len(user_ids) > BULK_THRESHOLD:
+            invalidation.publish("leaderboard_rebuild")
+        else:
+            invalidation.publish("leaderboard", user_ids)
+
+    # Relê da base de dados os utilizadores alterados noutro processo (user_ids=None: todos).
+    # Se este processo fizer uma alteração durante a leitura, o resultado pode ser anterior a ela e lê-se de novo.
+    async def reload(self, user_ids=None):
+        query = select(User.id, User.total_points)
+        if user_ids is not None:
+            query = query.where(User.id.in_(list(user_ids)))
+        for _ in range(3):
+            generation = self._generation
+            async with AsyncSessionLocal() as db:
+                rows = (await db.execute(query)).all()
+            if generation == self._generation:
+                break
+        if user_ids is None:
+            self._install(rows)
+            return
+        if self._touched is not None:
+            self._touched.update(user_ids)
+        with self._lock:
+            found = dict(rows)
+            for user_id in user_ids:
+                self._discard_locked(user_id)
+                if user_id in found:
+                    self._points[user_id] = found[user_id]
+                    insort(self._keys, (-found[user_id], user_id))
+
+    def _set(self, user_id, total_points):
+        with self._lock:
+            self._discard_locked(user_id)
+            self._points[user_id] = total_points
+            insort(self._keys, (-total_points, user_id))
+
+    def _set_many(self, totals):
+        if len(totals) <= BULK_THRESHOLD:
+            for user_id, total_points in totals.items():
+                self._set(user_id, total_points)
+            return
+        # Muitas alterações de uma vez: é mais barato reordenar tudo do que inserir uma a uma
+        with self._lock:
+            self._points.update(totals)
+            self._keys = sorted((-total_points, user_id) for user_id, total_points in self._points.items())
+
+    def _discard(self, user_id):
+        with self._lock:
+            self._discard_locked(user_id)
+
+    def _discard_locked(self, user_id):
+        old = self._points.pop(user_id, None)
+        if old is None:
+            return
+        i = bisect_left(self._keys, (-old, user_id))
+        if i < len(self._keys) and self._keys[i] == (-old, user_id):
+            del self._keys[i]
+
+    def _rank_of_points(self, total_points):
+        # Nº de utilizadores com mais pontos + 1
+        return bisect_left(self._keys, (-total_points,)) + 1
+
+    async def rank(self, db: AsyncSession, user_id: int):
+        if not self._loaded:
+            total_points = (await db.execute(
+                select(User.total_points).where(User.id == user_id)
+            )).scalar_one_or_none()
+            if total_points is None:
+                return None
+            return (await db.execute(RANK_OF_POINTS, {"total_points": total_points})).scalar_one() + 1, total_points
+        with self._lock:
+            total_points = self._points.get(user_id)
+            if total_points is None:
+                return None
+            return self._rank_of_points(total_points), total_points
+
+    async def ranks(self, db: AsyncSession, user_ids):
+        # Devolve {user_id: rank} para os utilizadores pedidos que estejam no leaderboard
+        if not self._loaded:
+            return dict((await db.execute(RANKS_OF_USERS, {"user_ids": list(user_ids)})).all())
+        with self._lock:
+            return {
+                user_id: self._rank_of_points(self._points[user_id])
+                for user_id in user_ids
+                if user_id in self._points
+            }
+
+    async def top(self, db: AsyncSession, n=None):
+        # Devolve [(rank, user_id, total_points), ...] ordenado; n=None devolve todos
+        if not self._loaded:
+            query = (
+                select(func.rank().over(order_by=User.total_points.desc()), User.id, User.total_points)
+                .order_by(User.total_points.desc(), User.id)
+            )
+            if n is not None:
+                query = query.limit(n)
+            return [tuple(row) for row in (await db.execute(query)).all()]
+        with self._lock:
+            keys = self._keys if n is None else self._keys[:n]
+            result = []
+            for i, (neg_points, user_id) in enumerate(keys):
+                if i > 0 and neg_points == keys[i - 1][0]:
+                    rank = result[-1][0]
+                else:
+                    rank = i + 1
+                result.append((rank, user_id, -neg_points))
+            return result
+
+
+# Rank de um utilizador na tabela user_ranks, construída uma só vez (é lida em cada escrita de pontos e no /rank)
+RANK_OF_USER = select(UserRank.rank, UserRank.total_points).where(UserRank.user_id == bindparam("user_id"))
+
+
+class TableLeaderboard:
+    # Tabela user_ranks com o rank já materializado. Quando um utilizador passa de old para new pontos,
+    # só mudam de rank os utilizadores cujos pontos estão entre old e new, o que é um único UPDATE por intervalo.
+    # As alterações correm na mesma transação da escrita que as originou.
+    #
+    # Custo nas escritas, e por isso este backend é para cenários com poucas escritas de pontos:
+    #   - o UPDATE por intervalo toca em todos os utilizadores entre old e new; os primeiros pontos de um
+    #     utilizador passam-no à frente de todos os que têm 0, o que é O(n) linhas
+    #   - todas as escritas de pontos (add_points, remove_points, complete_quest, ...) ficam em série no
+    #     sistema inteiro, porque cada uma segura o lock de _lock até ao commit
+    # Com muitas escritas concorrentes (ex.: os 200 clientes do benchmarks/loadtest_points.py) usar o backend memory.
+
+    async def _lock(self, db: AsyncSession):
+        # Serializa as escritas no ranking (em SQLite as escritas já são serializadas). É preciso porque o rank novo
+        # é calculado a partir do vizinho e o deslocamento a partir do total antigo: duas escritas concorrentes com
+        # intervalos sobrepostos veriam cada uma o estado anterior à outra (READ COMMITTED) e deixariam ranks errados.
+        # Um lock por intervalo de pontos não chega, porque o rank de cada linha depende de todas as que estão acima.
+        if db.get_bind().dialect.name == "postgresql":
+            await db.execute(text("SELECT pg_advisory_xact_lock(hashtext('user_ranks'))"))
+
+    async def rebuild(self, db: AsyncSession):
+        await self._rerank(db)
+        await db.commit()
+
+    async def _rerank(self, db: AsyncSession):
+        # Recalcula a tabela inteira dentro da transação actual
+        await self._lock(db)
+        await db.execute(delete(UserRank))
+        await db.execute(
+            insert(UserRank).from_select(
+                ["user_id", "total_points", "rank"],
+                select(
+                    User.id,
+                    User.total_points,
+                    func.rank().over(order_by=User.total_points.desc()),
+                ),
+            )
+        )
+
+    async def update_many(self, db: AsyncSession, totals):
+        if len(totals) <= BULK_THRESHOLD:
+            for user_id, total_points in totals.items():
+                await self.update(db, user_id, total_points)
+        else:
+            await self._rerank(db)
+
+    async def update(self, db: AsyncSession, user_id: int, total_points: int):
+        await self._lock(db)
+        old = (await db.execute(
+            select(UserRank.total_points).where(UserRank.user_id == user_id)
+        )).scalar_one_or_none()
+
+        if old == total_points:
+            return
+
+        others = UserRank.user_id != user_id
+        if old is None:
+            shifted = update(UserRank).where(others, UserRank.total_points < total_points).values(rank=UserRank.rank + 1)
+        elif total_points > old:
+            shifted = (
+                update(UserRank)
+                .where(others, UserRank.total_points >= old, UserRank.total_points < total_points)
+                .values(rank=UserRank.rank + 1)
+            )
+        else:
+            shifted = (
+                update(UserRank)
+                .where(others, UserRank.total_points >= total_points, UserRank.total_points < old)
+                .values(rank=UserRank.rank - 1)
+            )
+        await db.execute(shifted)
+
+        new_rank = await self._rank_after_shift(db, user_id, total_points)
+        if old is None:
+            await db.execute(insert(UserRank).values(user_id=user_id, total_points=total_points, rank=new_rank))
+        else:
+            await db.execute(
+                update(UserRank)
+                .where(UserRank.user_id == user_id)
+                .values(total_points=total_points, rank=new_rank)
+            )
+
+    async def _rank_after_shift(self, db: AsyncSession, user_id, total_points):
+        # O vizinho imediatamente abaixo (ou empatado) dá o rank por uma procura no índice:
+        # se estiver empatado partilha o rank, senão o nosso rank é o dele - 1.
+        neighbour = (await db.execute(
+            select(UserRank.total_points, UserRank.rank)
+            .where(UserRank.user_id != user_id, UserRank.total_points <= total_points)
+            .order_by(UserRank.total_points.desc())
+            .limit(1)
+        )).first()
+        if neighbour is not None:
+            return neighbour.rank if neighbour.total_points == total_points else neighbour.rank - 1
+
+        # Sem ninguém abaixo: fica em último
+        return (await db.execute(
+            select(func.count()).select_from(UserRank).where(UserRank.user_id != user_id)
+        )).scalar_one() + 1
+
+    async def remove(self, db: AsyncSession, user_id: int):
+        await self._lock(db)
+        old = (await db.execute(
+            select(UserRank.total_points).where(UserRank.user_id == user_id)
+        )).scalar_one_or_none()
+        if old is None:
+            return
+        await db.execute(delete(UserRank).where(UserRank.user_id == user_id))
+        await db.execute(update(UserRank).where(UserRank.total_points < old).values(rank=UserRank.rank - 1))
+
+    async def rank(self, db: AsyncSession, user_id: int):
+        row = (await db.execute(RANK_OF_USER, {"user_id": user_id})).first()
+        return (row.rank, row.total_points) if row else None
+
+    async def ranks(self, db: AsyncSession, user_ids):
+        rows = (await db.execute(
+            select(UserRank.user_id, UserRank.rank).where(UserRank.user_id.in_(list(user_ids)))
+        )).all()
+        return {row.user_id: row.rank for row in rows}
+
+    async def top(self, db: AsyncSession, n=None):
+        query = (
+            select(UserRank.rank, UserRank.user_id, UserRank.total_points)
+            .order_by(UserRank.total_points.desc(), UserRank.user_id)
+        )
+        if n is not None:
+            query = query.limit(n)
+        return [tuple(row) for row in (await db.execute(query)).all()]
+
+
+LEADERBOARD_BACKEND = os.getenv("LEADERBOARD_BACKEND", "memory")
+
+if LEADERBOARD_BACKEND == "table":
+    leaderboard = TableLeaderboard()
+elif LEADERBOARD_BACKEND == "memory":
+    leaderboard = MemoryLeaderboard()
+else:
+    raise RuntimeError(f"LEADERBOARD_BACKEND inválido: {LEADERBOARD_BACKEND}")
+
+# A tabela user_ranks é partilhada; só o leaderboard em memória precisa das alterações dos outros processos
+if isinstance(leaderboard, MemoryLeaderboard):
+    invalidation.subscribe("leaderboard", lambda items: leaderboard.reload({user_id for ids in items for user_id in ids}))
+    invalidation.subscribe("leaderboard_rebuild", lambda _: leaderboard.reload())
+    invalidation.subscribe("resync", lambda _: leaderboard.reload())
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("Uso: python leaderboard.py rebuild")
+        sys.exit(1)
+
+    async def rebuild_table():
+        async with AsyncSessionLocal() as db:
+            await TableLeaderboard().rebuild(db)
+
+    asyncio.run(rebuild_table())
+
+    print("✅ Tabela user_ranks reconstruída com sucesso!")
@@ -0,0 +1,127 @@
+from sqlalchemy import select, update, insert, func, literal, column, bindparam, Integer, String
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import User, Point
+from rollups import add_to_rollup
+
+# Alterações de pontos feitas no servidor da base de dados: o total é incrementado com
+# "total_points = total_points + :n" (sem ler o utilizador para Python) e a linha do historial
+# é escrita na mesma instrução, por isso pedidos concorrentes não perdem incrementos.
+# Cada alteração é também somada aos agregados diários (points_daily) na mesma transação.
+
+
+def new_total(db: AsyncSession, delta, clamp_at_zero: bool):
+    total = User.total_points + delta
+    if not clamp_at_zero:
+        return total
+    if db.get_bind().dialect.name == "sqlite":
+        return func.max(total, 0)  # Em SQLite o max com vários argumentos é escalar
+    return func.greatest(total, 0)
+
+
+# Soma delta aos pontos do utilizador e regista a alteração na tabela points.
+# Devolve o novo total, ou None se o utilizador não existir (e nesse caso nada é escrito).
+async def apply_points(db: AsyncSession, user_id: int, delta: int, message: str, clamp_at_zero: bool = False):
+    updated = (
+        update(User)
+        .where(User.id == user_id)
+        .values(total_points=new_total(db, delta, clamp_at_zero))
+        .returning(User.id, User.total_points)
+    )
+
+    if db.get_bind().dialect.name == "postgresql":
+        # WITH updated AS (UPDATE ... RETURNING), ledger AS (INSERT ... SELECT FROM updated) SELECT total_points FROM updated
+        updated = updated.cte("updated")
+        ledger = (
+            insert(Point)
+            .from_select(
+                ["user_id", "points_change", "message", "change_date"],
+                select(updated.c.id, literal(delta), literal(message), func.now()),
+            )
+            .returning(Point.id)
+            .cte("ledger")
+        )
+        total_points = (await db.execute(select(updated.c.total_points).add_cte(ledger))).scalar_one_or_none()
+        if total_points is not None:
+            await add_to_rollup(db, {user_id: delta})
+        return total_points
+
+    # Sem CTEs que alterem dados (ex.: SQLite): duas instruções na mesma transação
+    row = (await db.execute(updated)).first()
+    if row is None:
+        return None
+    await db.execute(insert(Point).values(user_id=user_id, points_change=delta, message=message))
+    await add_to_rollup(db, {user_id: delta})
+    return row.total_points
+
+
+# Atribuição em massa (ex.: uma turma inteira): awards é uma lista de (user_id, delta, message).
+# As variações são somadas por utilizador e aplicadas com um único UPDATE agrupado; o historial é
+# escrito com uma inserção multi-linha. Os totais nunca ficam negativos, como no remove_points.
+# Devolve {user_id: novo total} apenas para os utilizadores que existem.
+async def apply_points_bulk(db: AsyncSession, awards):
+    deltas = {}
+    for user_id, delta, _ in awards:
+        deltas[user_id] = deltas.get(user_id, 0) + delta
+
+    if not deltas:
+        return {}
+
+    if db.get_bind().dialect.name == "postgresql":
+        # UPDATE users SET total_points = GREATEST(total_points + d.delta, 0)
+        # FROM unnest(:user_ids, :deltas) AS d(user_id, delta) WHERE users.id = d.user_id
+        # Os arrays vão como dois parâmetros, por isso a instrução compila igual seja qual for o tamanho da turma.
+        d = func.unnest(
+            literal(list(deltas.keys()), ARRAY(Integer)),
+            literal(list(deltas.values()), ARRAY(Integer)),
+        ).table_valued(column("user_id", Integer), column("delta", Integer)).render_derived(name="d")
+        rows = (await db.execute(
+            update(User.__table__)
+            .where(User.id == d.c.user_id)
+            .values(total_points=new_total(db, d.c.delta, clamp_at_zero=True))
+            .returning(User.id, User.total_points)
+        )).all()
+        totals = {row.id: row.total_points for row in rows}
+    else:
+        await db.execute(
+            update(User.__table__)
+            .where(User.id == bindparam("uid"))
+            .values(total_points=new_total(db, bindparam("delta"), clamp_at_zero=True)),
+            [{"uid": user_id, "delta": delta} for user_id, delta in deltas.items()],
+        )
+        totals = dict(
+            (await db.execute(select(User.id, User.total_points).where(User.id.in_(list(deltas))))).all()
+        )
+
+    ledger_rows = [(user_id, delta, message) for user_id, delta, message in awards if user_id in totals]
+    if not ledger_rows:
+        return totals
+
+    await add_to_rollup(db, {user_id: deltas[user_id] for user_id in totals})
+
+    if db.get_bind().dialect.name == "postgresql":
+        # INSERT INTO points (...) SELECT * FROM unnest(:user_ids, :deltas, :messages)
+        user_ids, points_changes, messages = zip(*ledger_rows)
+        rows = func.unnest(
+            literal(list(user_ids), ARRAY(Integer)),
+            literal(list(points_changes), ARRAY(Integer)),
+            literal(list(messages), ARRAY(String)),
+        ).table_valued(column("user_id", Integer), column("points_change", Integer), column("message", String)).render_derived(name="rows")
+        await db.execute(
+            insert(Point.__table__).from_select(
+                ["user_id", "points_change", "message", "change_date"],
+                select(rows.c.user_id, rows.c.points_change, rows.c.message, func.now()),
+            )
+        )
+    else:
+        await db.execute(
+            insert(Point.__table__),
+            [
+                {"user_id": user_id, "points_change": delta, "message": message}
+                for user_id, delta, message in ledger_rows
+            ],
+        )
+
+    return totals
+
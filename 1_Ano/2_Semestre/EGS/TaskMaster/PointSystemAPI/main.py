@@ -1,37 +1,68 @@
-from fastapi import FastAPI, Depends, HTTPException, Query, File, UploadFile
-from fastapi.responses import RedirectResponse, JSONResponse
-import uuid
-from sqlalchemy import exc, desc, func
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Header
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
+from sqlalchemy import exc, update, bindparam
 from sqlalchemy.future import select
-from sqlalchemy.orm import Session
-from database import engine, SessionLocal
-from pydantic import BaseModel, EmailStr
+from sqlalchemy.dialects import postgresql, sqlite
+from database import AsyncSessionLocal, on_commit
+from pydantic import BaseModel, EmailStr, ValidationError
 from typing import List, Optional
-import models
-from models import User, Point, Badge, Quest
-from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from models import User, Badge, Quest
+from leaderboard import leaderboard, MemoryLeaderboard
+from ledger import apply_points, apply_points_bulk
+from api_keys import api_key_cache, hash_api_key, lookup_api_key, forget_api_key
+from rollups import window_ranking, WINDOWS
+from archive import HISTORY_FIRST_PAGE, HISTORY_NEXT_PAGE, HISTORY_COUNT
+import metrics
+import response_cache
+from serialization import FastJSONResponse
+import events
+import replicas
+import idempotency
+import invalidation
+import instrumentation
+from badges import assign_all_badges, reassign_badge_holders, update_user_badge, update_user_badges, badges_changed, DEFAULT_BATCH_SIZE
+from sqlalchemy.ext.asyncio import AsyncSession
 import secrets
+import base64
+from datetime import datetime
 
 app = FastAPI()
+app.add_middleware(instrumentation.RequestTimingMiddleware)
+
+# Dependência para obter sessão (assíncrona) da Base de Dados.
+# Nos pedidos de escrita, cada commit abre a janela read-your-writes do utilizador (ver replicas.py)
+async def get_db(request: Request):
+    async with AsyncSessionLocal() as db:
+        if request.method not in ("GET", "HEAD", "OPTIONS"):
+            replicas.note_writes_on_commit(db, replicas.request_user(request))
+        yield db
 
-# Dependência para obter sessão da Base de Dados.
-def get_db():
-    db = SessionLocal()
-    try:
+# Sessão para os endpoints só de leitura: uma réplica, se houver, salvo read-your-writes (ver replicas.py)
+async def get_read_db(request: Request):
+    async with replicas.router.session(replicas.request_user(request)) as db:
+        yield db
+
+# Igual, para respostas guardadas na cache partilhada (response_cache.py): com a cache ligada vão ao primário
+async def get_shared_read_db(request: Request):
+    async with replicas.router.session(replicas.request_user(request), shared=response_cache.enabled()) as db:
         yield db
-    finally:
-        db.close()
 
 # Modelos da API
 class UserCreate(BaseModel):
     name: str
     email: EmailStr
 
+class UserUpsert(BaseModel):
+    name: str
+
 class PointCreate(BaseModel):
     user_id: int
     points_change: int
     message: str
 
+class BulkPointsRequest(BaseModel):
+    awards: List[PointCreate]
+
 class PointHistoryResponse(BaseModel):
     points_change: int
     change_date: str
@@ -77,157 +108,500 @@ class BadgeResponse(BaseModel):
     class Config:
         orm_mode = True
 
-models.Base.metadata.create_all(bind=engine)
+# O esquema da base de dados é criado à parte, antes do arranque: python migrate.py create
+
+# Com vários workers: ouvir o canal de invalidação antes de carregar o que fica em memória (ver invalidation.py)
+@app.on_event("startup")
+async def start_invalidation():
+    await invalidation.start()
+
+@app.on_event("shutdown")
+async def stop_invalidation():
+    await invalidation.stop()
+
+# O leaderboard em memória é carregado em fundo, para o arranque não esperar pela leitura de todos os utilizadores;
+# até estar carregado responde com consultas à base de dados (ver leaderboard.py)
+@app.on_event("startup")
+async def load_leaderboard():
+    if isinstance(leaderboard, MemoryLeaderboard):
+        leaderboard.start_loading()
+
+@app.on_event("shutdown")
+async def stop_loading_leaderboard():
+    if isinstance(leaderboard, MemoryLeaderboard):
+        await leaderboard.stop_loading()
+
+@app.on_event("startup")
+async def start_replica_checks():
+    await replicas.router.start()
+
+@app.on_event("shutdown")
+async def stop_replica_checks():
+    await replicas.router.stop()
 
 # Redireciona a root da API para os docs para ser mais fácil aceder aos endpoints
 @app.get("/")
-def read_root():
+async def read_root():
     return RedirectResponse(url="/docs")
 
 # Cria um utilizador
 @app.post("/v1/users/")
-def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     db_user = User(name=user.name, email=user.email, total_points=0)
     db.add(db_user)
-    db.commit()
+    await db.flush()
+    await leaderboard.update(db, db_user.id, 0)
+    await db.commit()
+    await response_cache.bump("users")
     return {"message": "Utilizador criado com sucesso!"}
 
-# Atualiza um utilizador
-@app.patch("/v1/users/{user_id}/")
-def update_user(user_id: int, user: UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.id == user_id).first()
+# Email na forma normalizada pelo EmailStr (domínio em minúsculas), a mesma que o POST e o PATCH guardam;
+# None se não for um email válido
+def normalize_email(email: str):
+    try:
+        return UserCreate(name="", email=email).email
+    except ValidationError:
+        return None
 
-    if not db_user:
+def user_by_email_response(user):
+    return {
+        "user_id": user.id,
+        "name": user.name,
+        "email": user.email,
+        "total_points": user.total_points,
+    }
+
+# Procura um utilizador pelo email (uma só procura no índice único de users.email)
+@app.get("/v1/users/by-email/{email}")
+async def get_user_by_email(email: str, db: AsyncSession = Depends(get_db)):
+    email = normalize_email(email)
+    if email is None:
+        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+    user = (await db.execute(
+        select(User.id, User.name, User.email, User.total_points).where(User.email == email)
+    )).first()
+    if not user:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
 
-    db_user.name = user.name
-    db_user.email = user.email
+    return user_by_email_response(user)
+
+# Cria o utilizador se o email ainda não existir, senão actualiza o nome. Pode ser repetido sem efeitos extra,
+# por isso o login da app pode chamar só isto em vez de descarregar o ranking inteiro para ver se o email existe.
+@app.put("/v1/users/by-email/{email}")
+async def upsert_user_by_email(email: str, user: UserUpsert, db: AsyncSession = Depends(get_db)):
+    email = normalize_email(email)
+    if email is None:
+        raise HTTPException(status_code=422, detail="Email inválido!")
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = postgresql.insert(User)
+    elif dialect == "sqlite":
+        stmt = sqlite.insert(User)
+    else:
+        raise HTTPException(status_code=501, detail=f"Upsert não suportado para {dialect}.")
+
+    stmt = (
+        stmt.values(name=user.name, email=email, total_points=0)
+        .on_conflict_do_update(index_elements=[User.email], set_={"name": stmt.excluded.name})
+        .returning(User.id, User.name, User.email, User.total_points)
+    )
+    db_user = (await db.execute(stmt)).first()
+    await leaderboard.update(db, db_user.id, db_user.total_points)
+    await db.commit()
+    await response_cache.bump("users")
 
-    db.commit()
+    return user_by_email_response(db_user)
+
+# Atualiza um utilizador
+@app.patch("/v1/users/{user_id}/")
+async def update_user(user_id: int, user: UserCreate, db: AsyncSession = Depends(get_db)):
+    updated = await db.scalar(
+        update(User).where(User.id == user_id).values(name=user.name, email=user.email).returning(User.id)
+    )
+    if updated is None:
+        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+    await db.commit()
+    await response_cache.bump("users")
 
     return {"message": "Utilizador actualizado com sucesso!"}
 
 
 # Remove um utilizador à escolha com base no ID de utilizador
 @app.delete("/v1/users/{user_id}")
-def remove_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.id == user_id).first()
+async def remove_user(user_id: int, db: AsyncSession = Depends(get_db)):
+    db_user = await db.get(User, user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
     try:
-        db.delete(db_user)
-        db.commit()
+        await leaderboard.remove(db, user_id)
+        if db_user.api_key_hash:
+            key_hash = db_user.api_key_hash
+            on_commit(db, lambda: forget_api_key(key_hash))
+        await db.delete(db_user)
+        await db.commit()
+        await response_cache.bump("users", f"quests:{user_id}")
         return {"message": "Utilizador removido com sucesso!"}
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Um erro ocorreu enquanto o utilizador era removido!")
 
+# Cursor opaco para a paginação do ranking: codifica (total_points, id) do último utilizador da página
+def encode_rank_cursor(total_points: int, user_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{total_points}:{user_id}".encode()).decode()
+
+def decode_rank_cursor(cursor: str):
+    try:
+        total_points, user_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return int(total_points), int(user_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido!")
+
+def ranking_query():
+    return (
+        select(User.id, User.name, User.email, User.total_points, Badge.name.label("badge_name"))
+        .join(Badge, User.current_badge_id == Badge.id, isouter=True)
+    )
+
+# Instruções do ranking construídas uma só vez (só mudam os parâmetros), todas sobre o índice ix_users_total_points_id.
+RANKING_TOP = ranking_query().order_by(User.total_points.desc(), User.id).limit(bindparam("limit"))
+
+RANKING_USER = ranking_query().where(User.id == bindparam("user_id"))
+
+# Utilizadores depois de (total_points, id) na ordem do ranking (total_points DESC, id ASC).
+# O total_points <= :p fica como condição do índice ix_users_total_points_id, o resto é só filtro.
+RANKED_AFTER = (
+    ranking_query()
+    .where(User.total_points <= bindparam("total_points"))
+    .where((User.total_points < bindparam("total_points")) | (User.id > bindparam("user_id")))
+    .order_by(User.total_points.desc(), User.id)
+    .limit(bindparam("limit"))
+)
+
+# Utilizadores antes de (total_points, id), do mais próximo para o mais afastado (mesmo índice percorrido ao contrário)
+RANKED_BEFORE = (
+    ranking_query()
+    .where(User.total_points >= bindparam("total_points"))
+    .where((User.total_points > bindparam("total_points")) | (User.id < bindparam("user_id")))
+    .order_by(User.total_points, User.id.desc())
+    .limit(bindparam("limit"))
+)
+
+async def ranking_page(db: AsyncSession, rows):
+    ranks = await leaderboard.ranks(db, [row.id for row in rows])
+    return [
+        {
+            "rank": ranks.get(row.id),
+            "user_id": row.id,
+            "name": row.name,
+            "email": row.email,
+            "total_points": row.total_points,
+            "badge": row.badge_name if row.badge_name else None
+        }
+        for row in rows
+    ]
+
 # Retorna todos os utilizadores presentes na base de dados em formato de rank, atualizado após recomendação do professor de não usar um get á parte para o ranking e juntar tudo no get_users
+# A ordem e o rank vêm do leaderboard (mantido nas escritas), já não é preciso juntar a tabela points e agrupar.
+# Modos paginados (sem OFFSET, todos sobre o índice de users.total_points):
+#   ?top=N              -> os N primeiros
+#   ?limit=L&cursor=C   -> página seguinte ao cursor (next_cursor da resposta anterior)
+#   ?around=ID&n=N      -> os N vizinhos acima e abaixo do utilizador ID
+# Sem parâmetros mantém o comportamento antigo (ranking completo).
+# As respostas ficam na cache de respostas até à próxima escrita em utilizadores/pontos/badges (ETag + 304).
 @app.get("/v1/users/")
-def get_users(db: Session = Depends(get_db)):
-    result = db.execute(
-        select(
-            User.id,
-            User.name,
-            User.total_points,
-            User.email,
-            Badge.name.label("badge_name")
-        )
-        .join(Point, User.id == Point.user_id, isouter=True)
-        .join(Badge, User.current_badge_id == Badge.id, isouter=True)
-        .group_by(User.id, User.name, User.total_points, User.email, Badge.name)
-        .order_by(desc(User.total_points))
+async def get_users(
+    request: Request,
+    db: AsyncSession = Depends(get_shared_read_db),
+    top: Optional[int] = Query(None, ge=1, le=500),
+    limit: Optional[int] = Query(None, ge=1, le=500),
+    cursor: Optional[str] = None,
+    around: Optional[int] = None,
+    n: int = Query(5, ge=1, le=50)
+):
+    return await response_cache.cached_response(
+        request, "users", lambda: users_ranking(db, top, limit, cursor, around, n)
     )
 
-    users = result.fetchall()
+async def users_ranking(db: AsyncSession, top, limit, cursor, around, n):
+    if sum(mode is not None for mode in (top, limit, around)) > 1:
+        raise HTTPException(status_code=400, detail="Usar apenas um dos modos: top, limit/cursor ou around.")
+
+    if top is not None:
+        rows = (await db.execute(RANKING_TOP, {"limit": top})).all()
+        return {"ranking": await ranking_page(db, rows)}
+
+    if around is not None:
+        user = (await db.execute(select(User.id, User.total_points).where(User.id == around))).first()
+        if not user:
+            raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+        position = {"total_points": user.total_points, "user_id": user.id, "limit": n}
+        above = (await db.execute(RANKED_BEFORE, position)).all()
+        me = (await db.execute(RANKING_USER, {"user_id": user.id})).all()
+        below = (await db.execute(RANKED_AFTER, position)).all()
+        return {"ranking": await ranking_page(db, list(reversed(above)) + me + below)}
+
+    if limit is not None or cursor is not None:
+        page_size = limit or 50
+        # Pede-se mais uma linha só para saber se há página seguinte
+        if cursor is None:
+            rows = (await db.execute(RANKING_TOP, {"limit": page_size + 1})).all()
+        else:
+            total_points, user_id = decode_rank_cursor(cursor)
+            rows = (await db.execute(
+                RANKED_AFTER, {"total_points": total_points, "user_id": user_id, "limit": page_size + 1}
+            )).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        return {
+            "ranking": await ranking_page(db, rows),
+            "next_cursor": encode_rank_cursor(rows[-1].total_points, rows[-1].id) if has_more else None
+        }
+
+    entries = await leaderboard.top(db)
 
-    if not users:
+    if not entries:
         return {"ranking": []}
 
+    details = {
+        row.id: row
+        for row in (await db.execute(
+            select(User.id, User.name, User.email, Badge.name.label("badge_name"))
+            .join(Badge, User.current_badge_id == Badge.id, isouter=True)
+        ))
+    }
+
     ranking = [
         {
-            "rank": i + 1,
-            "user_id": user[0],
-            "name": user[1],
-            "email": user[3],
-            "total_points": user[2],
-            "badge": user[4] if user[4] else None
+            "rank": rank,
+            "user_id": user_id,
+            "name": details[user_id].name,
+            "email": details[user_id].email,
+            "total_points": total_points,
+            "badge": details[user_id].badge_name if details[user_id].badge_name else None
         }
-        for i, user in enumerate(users)
+        for rank, user_id, total_points in entries
+        if user_id in details
     ]
 
     return {"ranking": ranking}
 
+# Ranking por período a partir dos agregados diários (points_daily), sem percorrer o historial:
+#   7d -> últimos 7 dias, 30d -> últimos 30 dias, term -> desde o início do semestre
+@app.get("/v1/leaderboards")
+async def get_window_leaderboard(
+    window: str = Query("7d"),
+    limit: int = Query(10, ge=1, le=500),
+    db: AsyncSession = Depends(get_read_db)
+):
+    if window not in WINDOWS:
+        raise HTTPException(status_code=400, detail=f"Período inválido, usar um de: {', '.join(WINDOWS)}")
+
+    since, rows = await window_ranking(db, window, limit)
+
+    return FastJSONResponse({
+        "window": window,
+        "since": since.isoformat(),
+        "ranking": [
+            {
+                "rank": row.rank,
+                "user_id": row.id,
+                "name": row.name,
+                "email": row.email,
+                "points": row.points,
+                "badge": row.badge_name if row.badge_name else None
+            }
+            for row in rows
+        ]
+    })
+
+# Rank de um utilizador (utilizadores empatados partilham o mesmo rank)
+@app.get("/v1/users/{user_id}/rank")
+async def get_user_rank(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    result = await leaderboard.rank(db, user_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+    rank, total_points = result
+    return {"user_id": user_id, "rank": rank, "total_points": total_points}
+
+# Reconstrói o leaderboard do zero a partir de users.total_points
+@app.post("/v1/leaderboard/rebuild")
+async def rebuild_leaderboard(db: AsyncSession = Depends(get_db)):
+    await leaderboard.rebuild(db)
+    invalidation.publish("leaderboard_rebuild")
+    await response_cache.bump("users")
+    return {"message": "Leaderboard reconstruído com sucesso!"}
+
 
 
 
+# Stream (Server-Sent Events) das alterações de pontos, rank e badges, para os clientes não terem que
+# voltar a pedir o ranking inteiro. ?user_id=N recebe só os eventos desse utilizador. Ver events.py.
+@app.get("/v1/stream")
+async def stream_events(user_id: Optional[int] = None):
+    return StreamingResponse(
+        events.stream(user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/v1/stream/stats")
+async def stream_stats():
+    return events.hub.stats()
+
+# Métricas no formato do Prometheus (pool de ligações à base de dados, ver database.py e metrics.py)
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
 # Adiciona pontos ao utilizador
 @app.post("/v1/users/{user_id}/points/")
-def add_points(user_id: int, points: int, message: str, db: Session = Depends(get_db)):
+async def add_points(user_id: int, points: int, message: str, db: AsyncSession = Depends(get_db)):
     if points <= 0:
         raise HTTPException(status_code=400, detail="Pontos a atribuir têm que ter um valor positivo")
     
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    # Um só UPDATE ... RETURNING + inserção no historial, sem ler o utilizador antes
+    total_points = await apply_points(db, user_id, points, message)
+    if total_points is None:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+    badge = await update_user_badge(db, user_id, total_points)
+    await leaderboard.update(db, user_id, total_points)
+    await db.commit()
+    await response_cache.bump("users")
+    await events.publish_points(db, user_id, total_points, badge)
     
-    new_point = Point(user_id=user_id, points_change=points, message=message)
-    db.add(new_point)
-    user.total_points += points
-    db.commit()
-    
-    return {"message": "Pontos atribuidos com sucesso!", "total_points": user.total_points}
+    return {"message": "Pontos atribuidos com sucesso!", "total_points": total_points}
 
 
 # Remove pontos do utilizador
 @app.delete("/v1/users/{user_id}/points/")
-def remove_points(user_id: int, points: int, message: str, db: Session = Depends(get_db)):
+async def remove_points(user_id: int, points: int, message: str, db: AsyncSession = Depends(get_db)):
     if points <= 0:
         raise HTTPException(status_code=400, detail="Pontos a remover têm que ter um valor positivo")
     
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    total_points = await apply_points(db, user_id, -abs(points), message, clamp_at_zero=True)
+    if total_points is None:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+    badge = await update_user_badge(db, user_id, total_points)
+    await leaderboard.update(db, user_id, total_points)
+    await db.commit()
+    await response_cache.bump("users")
+    await events.publish_points(db, user_id, total_points, badge)
     
-    new_point = Point(user_id=user_id, points_change=-abs(points), message=message)
-    db.add(new_point)
-    user.total_points = max(0, user.total_points - abs(points))
-    db.commit()
-    
-    return {"message": "Pontos removidos com sucesso!", "total_points": user.total_points}
+    return {"message": "Pontos removidos com sucesso!", "total_points": total_points}
+
+# Atribui (ou retira) pontos a vários utilizadores de uma vez, ex.: uma turma inteira.
+# Um UPDATE agrupado + uma inserção multi-linha no historial, num só commit. Devolve o resultado de cada linha pela ordem recebida.
+MAX_BULK_AWARDS = 20000
+
+@app.post("/v1/points/bulk")
+async def add_points_bulk(request: BulkPointsRequest, db: AsyncSession = Depends(get_db)):
+    if len(request.awards) > MAX_BULK_AWARDS:
+        raise HTTPException(status_code=413, detail=f"Máximo de {MAX_BULK_AWARDS} atribuições por pedido.")
+
+    awards = [(a.user_id, a.points_change, a.message) for a in request.awards if a.points_change != 0]
+    totals = await apply_points_bulk(db, awards)
+    await update_user_badges(db, totals)
+    await leaderboard.update_many(db, totals)
+    await db.commit()
+    await response_cache.bump("users")
+    await events.publish_points_many(db, totals)
+
+    results = []
+    for a in request.awards:
+        if a.points_change == 0:
+            results.append({"user_id": a.user_id, "status": "invalid", "detail": "Pontos têm que ser diferentes de zero"})
+        elif a.user_id not in totals:
+            results.append({"user_id": a.user_id, "status": "not_found", "detail": "Utilizador não encontrado!"})
+        else:
+            results.append({"user_id": a.user_id, "status": "ok", "total_points": totals[a.user_id]})
+
+    return {
+        "message": "Pontos atribuidos com sucesso!",
+        "applied": sum(r["status"] == "ok" for r in results),
+        "results": results
+    }
+
+# Cursor opaco para a paginação do histórico: codifica (change_date, id) da última linha da página
+def encode_history_cursor(change_date: datetime, point_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{change_date.isoformat()}|{point_id}".encode()).decode()
+
+def decode_history_cursor(cursor: str):
+    try:
+        change_date, point_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(change_date), int(point_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido!")
+
+USER_SUMMARY = select(User.id, User.name, User.email, User.total_points).where(User.id == bindparam("user_id"))
+
+# Colunas de que os caminhos de escrita precisam, sem carregar a entidade User inteira (nem o badge)
+USER_CORE = select(User.id, User.total_points, User.api_key_hash, User.current_badge_id).where(User.id == bindparam("user_id"))
 
 # Histórico de pontos de um utilizador, onde se sabe quantos pontos recebou ou lhe foram retirados e em que dia.
+# Ordenado por (change_date DESC, id DESC), a ordem do índice ix_points_user_date_id.
+# Depois das linhas recentes vêm os meses arquivados, um resumo por mês (ver archive.py).
+#   ?limit=L&cursor=C -> página seguinte ao cursor (next_cursor da resposta anterior); custa o mesmo em qualquer página
+#   ?skip=S&limit=L   -> paginação antiga por OFFSET, mantida por compatibilidade
+# O total exacto (COUNT(*) sobre o historial todo) só é calculado com count=true; por omissão só no modo antigo.
 @app.get("/v1/points/history/{user_id}")
-def get_user_points_history(
+async def get_user_points_history(
     user_id: int,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
     skip: int = Query(0, ge=0),  # Quantos valores queremos passar a frente, ou seja se o skip for 10 e tivermos 100 resultados. Aparecem do resultado 10 ao 100 (dá skip ao 1 a 10)
-    limit: int = Query(10, ge=1, le=100)  # Quantidade de resultados por página
+    limit: int = Query(10, ge=1, le=100),  # Quantidade de resultados por página
+    cursor: Optional[str] = None,
+    count: Optional[bool] = None
 ):
+    if cursor is not None and skip:
+        raise HTTPException(status_code=400, detail="Usar skip ou cursor, não os dois.")
+
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        # Só as colunas necessárias, sem carregar a entidade User (nem o badge que vem com ela)
+        user = (await db.execute(USER_SUMMARY, {"user_id": user_id})).first()
         if not user:
             raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
 
-        # Obter todos os resultados antes da paginação
-        total_results = db.query(Point).filter(Point.user_id == user_id).count()
-
-        # Fetch paginated history
-        history = (
-            db.query(Point)
-            .filter(Point.user_id == user_id)
-            .order_by(desc(Point.change_date))
-            .offset(skip)
-            .limit(limit)
-            .all()
-        )
+        # Linhas recentes seguidas dos resumos mensais arquivados (ver archive.py).
+        # Pede-se mais uma linha só para saber se há página seguinte
+        params = {"user_id": user_id, "limit": limit + 1, "skip": skip}
+        if cursor is None:
+            rows = (await db.execute(HISTORY_FIRST_PAGE, params)).all()
+        else:
+            params["after_date"], params["after_id"] = decode_history_cursor(cursor)
+            rows = (await db.execute(HISTORY_NEXT_PAGE, params)).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        if count is None:
+            count = cursor is None
+        total_results = None
+        if count:
+            total_results = await db.scalar(HISTORY_COUNT, {"user_id": user_id})
+
+        # Com cursor o total não diz quantas linhas faltam depois desta página: só se sabe que é 0 na última
+        if cursor is not None:
+            remaining = None if has_more else 0
+        elif total_results is not None:
+            remaining = max(0, total_results - (skip + limit))
+        else:
+            remaining = None
 
         history_data = [
-            {"points_change": p.points_change, "change_date": p.change_date.isoformat(), "message": p.message} 
-            for p in history
+            {"points_change": p.points_change, "change_date": p.change_date.isoformat(), "message": p.message}
+            if p.id else
+            {"points_change": p.points_change, "change_date": p.change_date.isoformat(), "message": f"Resumo arquivado de {p.entries} alterações", "archived": True}
+            for p in rows
         ]
 
-        return {
+        return FastJSONResponse({
             "user_id": user.id,
             "name": user.name,
             "email": user.email,
@@ -237,38 +611,52 @@ def get_user_points_history(
             "pagination": {
                 "skip": skip,
                 "limit": limit,
-                "remaining": max(0, total_results - (skip + limit))
+                "remaining": remaining,
+                "next_cursor": encode_history_cursor(rows[-1].change_date, rows[-1].id) if has_more else None
             }
-        }
+        })
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
     
 @app.post("/v1/generate-api-key")
-def generate_api_key(user_id: int, db: Session = Depends(get_db)):
+async def generate_api_key(user_id: int, db: AsyncSession = Depends(get_db)):
     # Gera uma nova chave de API para um utilizador, substituindo a anterior.
 
-    user = db.query(User).filter(User.id == user_id).first()
+    user = (await db.execute(USER_CORE, {"user_id": user_id})).first()
     if not user:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado.")
 
     new_api_key = secrets.token_hex(32)  # Gera uma chave segura
-    user.api_key = new_api_key  # Substitui a chave antiga
-    db.commit()
-    db.refresh(user)
+    old_hash = user.api_key_hash
+    # Substitui a chave antiga (só o hash fica guardado)
+    await db.execute(
+        update(User).where(User.id == user_id).values(api_key_hash=hash_api_key(new_api_key), api_key=None)
+    )
+    if old_hash:
+        on_commit(db, lambda: forget_api_key(old_hash))
+    await db.commit()
 
     return {"api_key": new_api_key}
 
 @app.get("/v1/validate-api-key")
-async def validate_api_key(api_key: str, db: Session = Depends(get_db)):
+async def validate_api_key(api_key: str, db: AsyncSession = Depends(get_db)):
     
     # Verifica se a chave de API é válida e retorna o ID do utilizador correspondente.
-    
-    user = db.query(User).filter(User.api_key == api_key).first()
-    if not user:
+    # As chaves validadas recentemente são respondidas da cache, sem ir à base de dados.
+    user_id = await lookup_api_key(db, api_key)
+    if user_id is None:
         raise HTTPException(status_code=401, detail="API key inválida.")
 
-    return {"valid": True, "user_id": user.id}
+    return {"valid": True, "user_id": user_id}
+
+
+# Métricas da cache de validação de chaves (hits, misses, hit rate, ...)
+@app.get("/v1/validate-api-key/stats")
+async def api_key_cache_stats():
+    return api_key_cache.stats()
 
 
 @app.post("/v1/badge")
@@ -277,9 +665,9 @@ async def create_badge(
     threshold: int,
     image_filename: str,
     description: str = "",
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    existing = db.query(Badge).filter(Badge.name == name).first()
+    existing = await db.scalar(select(Badge).where(Badge.name == name))
     if existing:
         raise HTTPException(status_code=400, detail="Badge com este nome já existe.")
 
@@ -290,8 +678,13 @@ async def create_badge(
         image_filename=image_filename,
     )
     db.add(badge)
-    db.commit()
-    db.refresh(badge)
+    badges_changed(db)
+    await db.commit()
+    await db.refresh(badge)
+
+    # Os utilizadores que já têm pontos para o novo badge passam a tê-lo (só as linhas que mudam são escritas)
+    events.publish_badges(await assign_all_badges(db))
+    await response_cache.bump("badges", "users")
 
     return {
         "message": "Badge criado com sucesso!",
@@ -299,66 +692,60 @@ async def create_badge(
     }
 
 @app.post("/v1/badge/assign")
-async def assign_badges(db: Session = Depends(get_db)):
-    # Fetch all badges ordered from highest to lowest threshold
-    badges = db.query(Badge).order_by(Badge.threshold.desc()).all()
+async def assign_badges(db: AsyncSession = Depends(get_db), batch_size: int = Query(DEFAULT_BATCH_SIZE, ge=1)):
+    badges = dict((await db.execute(select(Badge.id, Badge.name))).all())
     if not badges:
         raise HTTPException(status_code=404, detail="Nenhum badge encontrado.")
 
-    users = db.query(User).all()
-    if not users:
+    if await db.scalar(select(User.id).limit(1)) is None:
         raise HTTPException(status_code=404, detail="Nenhum utilizador encontrado.")
 
-    updated_users = []
-
-    for user in users:
-        assigned = False
-        for badge in badges:
-            if user.total_points >= badge.threshold:
-                if user.current_badge_id != badge.id:
-                    user.current_badge_id = badge.id
-                    updated_users.append({
-                        "user_id": user.id,
-                        "name": user.name,
-                        "new_badge": badge.name
-                    })
-                assigned = True
-                break  # Badge encontrado, parar de procurar
-        if not assigned and user.current_badge_id is not None:
-            # Se o utilizador não tem pontos para nenhum badge, remove
-            user.current_badge_id = None
-
-    db.commit()
+    # O badge de cada utilizador é calculado e escrito na base de dados, por lotes de ids
+    changed = await assign_all_badges(db, batch_size)
+    await response_cache.bump("users")
+    events.publish_badges(changed)
 
     return {
         "message": "Badges atribuídos com base nos pontos.",
-        "updated": updated_users
+        "updated": [
+            {"user_id": user_id, "name": name, "new_badge": badges.get(badge_id)}
+            for user_id, name, badge_id in changed
+            if badge_id is not None
+        ]
     }
 
 
 @app.delete("/v1/badges/{badge_id}")
-def remove_badge(badge_id: int, db: Session = Depends(get_db)):
-    db_badge = db.query(Badge).filter(Badge.id == badge_id).first()
+async def remove_badge(badge_id: int, db: AsyncSession = Depends(get_db)):
+    db_badge = await db.get(Badge, badge_id)
     if db_badge is None:
         raise HTTPException(status_code=404, detail="Badge não encontrado!")
     try:
-        db.delete(db_badge)
-        db.commit()
-        return {"message": "Badge removido com sucesso!"}
+        # Quem tinha este badge recebe o melhor dos que restam, na mesma transação que o remove
+        changed = await reassign_badge_holders(db, badge_id)
+        await db.delete(db_badge)
+        badges_changed(db)
+        await db.commit()
     except exc.SQLAlchemyError:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Um erro ocorreu enquanto o badge era removido!")
 
+    await response_cache.bump("badges", "users")
+    events.publish_badges(changed)
+    return {"message": "Badge removido com sucesso!"}
+
 @app.get("/v1/badges", response_model=List[BadgeResponse])
-async def list_badges(db: Session = Depends(get_db)):
-    badges = db.query(Badge).all()
-    return badges
+async def list_badges(request: Request, db: AsyncSession = Depends(get_shared_read_db)):
+    async def build():
+        badges = (await db.scalars(select(Badge))).all()
+        return [BadgeResponse.model_validate(badge, from_attributes=True) for badge in badges]
+
+    return await response_cache.cached_response(request, "badges", build)
 
 
 @app.post("/v1/quests/")
-def create_quest(quest: QuestCreate, user_id: int, db: Session = Depends(get_db)):
-    db_user = db.query(User).filter(User.id == user_id).first()
-    if not db_user:
+async def create_quest(quest: QuestCreate, user_id: int, db: AsyncSession = Depends(get_db)):
+    if await db.scalar(select(User.id).where(User.id == user_id)) is None:
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
 
     new_quest = Quest(
@@ -369,50 +756,183 @@ def create_quest(quest: QuestCreate, user_id: int, db: Session = Depends(get_db)
     )
 
     db.add(new_quest)
-    db.commit()
-    db.refresh(new_quest)
+    await db.commit()
+    await response_cache.bump(f"quests:{user_id}")
 
     return {"message": "Quest criada com sucesso!", "quest_id": new_quest.id}
 
 @app.post("/v1/quests/{quest_id}/complete")
-def complete_quest(quest_id: int, db: Session = Depends(get_db)):
-    quest = db.query(Quest).filter(Quest.id == quest_id).first()
-    if not quest:
-        raise HTTPException(status_code=404, detail="Quest não encontrada!")
-    
-    if quest.completed:
+async def complete_quest(
+    quest_id: int,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, max_length=idempotency.MAX_KEY_LENGTH)
+):
+    # Com Idempotency-Key, uma repetição do pedido recebe a resposta do primeiro sem voltar a atribuir pontos
+    request_id = f"POST /v1/quests/{quest_id}/complete"
+    if idempotency_key:
+        replayed = await idempotency.begin(db, idempotency_key, request_id)
+        if replayed is not None:
+            return replayed
+
+    # Marcar a quest como completada só se ainda não estava: dois pedidos ao mesmo tempo não passam ambos
+    completed = (await db.execute(
+        update(Quest)
+        .where(Quest.id == quest_id, Quest.completed.is_not(True))
+        .values(completed=True)
+        .returning(Quest.user_id, Quest.points, Quest.title)
+    )).first()
+    if completed is None:
+        exists = await db.scalar(select(Quest.id).where(Quest.id == quest_id))
+        if exists is None:
+            raise HTTPException(status_code=404, detail="Quest não encontrada!")
         raise HTTPException(status_code=400, detail="A quest já foi completada!")
 
-    # Marcar a quest como completada
-    quest.completed = True
-    db.commit()
-
-    # Atribuir os pontos ao utilizador
-    user = db.query(User).filter(User.id == quest.user_id).first()
-    if not user:
+    # Atribuir os pontos ao utilizador (com linha no historial), na mesma transação
+    points = completed.points or 0
+    total_points = await apply_points(db, completed.user_id, points, f"Quest '{completed.title}' concluída")
+    if total_points is None:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
-    
-    user.total_points += quest.points
-    db.commit()
 
-    return {"message": f"Quest '{quest.title}' concluída com sucesso! {quest.points} pontos atribuídos."}
+    badge = await update_user_badge(db, completed.user_id, total_points)
+    await leaderboard.update(db, completed.user_id, total_points)
 
+    response = {"message": f"Quest '{completed.title}' concluída com sucesso! {points} pontos atribuídos."}
+    if idempotency_key:
+        await idempotency.remember(db, idempotency_key, request_id, response)
+    await db.commit()
+    await response_cache.bump("users", f"quests:{completed.user_id}")
+    await events.publish_points(db, completed.user_id, total_points, badge)
 
-@app.get("/v1/quests/user/{user_id}")
-def get_quests_by_user(user_id: int, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
-        raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+    return response
 
-    quests = db.query(Quest).filter(Quest.user_id == user_id).all()
 
-    return [
+# Cursor opaco para a paginação das quests: codifica (user_id, id) da última quest da página
+def encode_quest_cursor(user_id: int, quest_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{user_id}|{quest_id}".encode()).decode()
+
+def decode_quest_cursor(cursor: str):
+    try:
+        user_id, quest_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return int(user_id), int(quest_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursor inválido!")
+
+# Página de quests de um ou vários utilizadores, ordenada por (user_id, id) como os índices ix_quests_user_*.
+# completed filtra pelo estado, title pelo início do título. Devolve (quests, next_cursor).
+async def quests_page(db: AsyncSession, user_ids, completed: Optional[bool], title: Optional[str], limit: int, cursor: Optional[str]):
+    query = select(
+        Quest.id, Quest.user_id, Quest.title, Quest.description, Quest.points, Quest.completed
+    ).where(Quest.user_id.in_(user_ids))
+    if completed is not None:
+        # Comparações de igualdade para usar ix_quests_user_completed_id; completed a NULL (quests antigas) conta como não completada
+        if completed:
+            query = query.where(Quest.completed == True)
+        else:
+            query = query.where((Quest.completed == False) | Quest.completed.is_(None))
+    if title:
+        query = query.where(Quest.title.startswith(title, autoescape=True))
+    if cursor is not None:
+        after_user, after_id = decode_quest_cursor(cursor)
+        query = query.where(Quest.user_id >= after_user).where(
+            (Quest.user_id > after_user) | (Quest.id > after_id)
+        )
+
+    # Pede-se mais uma linha para saber se há página seguinte
+    rows = (await db.execute(query.order_by(Quest.user_id, Quest.id).limit(limit + 1))).all()
+    next_cursor = encode_quest_cursor(rows[limit - 1].user_id, rows[limit - 1].id) if len(rows) > limit else None
+
+    quests = [
         {
-            "id": quest.id,
-            "title": quest.title,
-            "description": quest.description,
-            "points": quest.points,
-            "completed": quest.completed,
+            "id": row.id,
+            "user_id": row.user_id,
+            "title": row.title,
+            "description": row.description,
+            "points": row.points,
+            "completed": bool(row.completed),
         }
-        for quest in quests
+        for row in rows[:limit]
     ]
+    return quests, next_cursor
+
+
+# Todas as quests de um utilizador, pela ordem do índice ix_quests_user_id
+USER_QUESTS = (
+    select(Quest.id, Quest.title, Quest.description, Quest.points, Quest.completed)
+    .where(Quest.user_id == bindparam("user_id"))
+    .order_by(Quest.id)
+)
+
+# Quests de um utilizador: ?completed=true|false, ?title=prefixo, ?limit=L&cursor=C (next_cursor da página anterior)
+# Sem nenhum destes parâmetros devolve a lista completa, no formato de sempre (as apps fazem polling deste endpoint)
+@app.get("/v1/quests/user/{user_id}")
+async def get_quests_by_user(
+    user_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_shared_read_db),
+    completed: Optional[bool] = None,
+    title: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    async def build():
+        if completed is None and title is None and limit is None and cursor is None:
+            rows = (await db.execute(USER_QUESTS, {"user_id": user_id})).all()
+            if not rows and await db.scalar(select(User.id).where(User.id == user_id)) is None:
+                raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+            return [
+                {
+                    "id": row.id,
+                    "title": row.title,
+                    "description": row.description,
+                    "points": row.points,
+                    "completed": row.completed,
+                }
+                for row in rows
+            ]
+
+        page_size = limit or 100
+        quests, next_cursor = await quests_page(db, [user_id], completed, title, page_size, cursor)
+
+        # Só se não vier nenhuma quest é preciso saber se o utilizador existe
+        if not quests and await db.scalar(select(User.id).where(User.id == user_id)) is None:
+            raise HTTPException(status_code=404, detail="Utilizador não encontrado!")
+
+        return {
+            "user_id": user_id,
+            "quests": quests,
+            "pagination": {"limit": page_size, "next_cursor": next_cursor},
+        }
+
+    return await response_cache.cached_response(request, f"quests:{user_id}", build)
+
+
+MAX_QUEST_USERS = 500
+
+# Quests de vários utilizadores num só pedido (ex.: uma turma inteira no painel do professor): ?user_ids=1,2,3
+# Aceita os mesmos filtros e paginação que /v1/quests/user/{user_id}; utilizadores inexistentes não têm quests.
+@app.get("/v1/quests")
+async def get_quests_by_users(
+    user_ids: str,
+    db: AsyncSession = Depends(get_read_db),
+    completed: Optional[bool] = None,
+    title: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None
+):
+    try:
+        ids = sorted({int(user_id) for user_id in user_ids.split(",") if user_id.strip()})
+    except ValueError:
+        raise HTTPException(status_code=400, detail="user_ids deve ser uma lista de ids separados por vírgulas.")
+    if not ids:
+        raise HTTPException(status_code=400, detail="Indicar pelo menos um utilizador em user_ids.")
+    if len(ids) > MAX_QUEST_USERS:
+        raise HTTPException(status_code=400, detail=f"No máximo {MAX_QUEST_USERS} utilizadores por pedido.")
+
+    quests, next_cursor = await quests_page(db, ids, completed, title, limit, cursor)
+
+    return FastJSONResponse({
+        "quests": quests,
+        "pagination": {"limit": limit, "next_cursor": next_cursor},
+    })
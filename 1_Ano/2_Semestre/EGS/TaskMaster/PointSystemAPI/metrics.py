@@ -0,0 +1,110 @@
+import threading
+
+# Métricas do processo no formato de texto do Prometheus, servidas em GET /metrics.
+# Implementação mínima (contadores, histogramas e valores lidos na altura do pedido) para não depender
+# do prometheus_client. Com vários workers cada processo tem as suas métricas.
+
+# Limites dos buckets dos histogramas de tempos, em segundos
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+class Counter:
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [contagem por bucket..., contagem total, soma]
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f"{self.name}_bucket{format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels + (('le', '+Inf'),))} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    # Valor lido só quando as métricas são pedidas: collect() devolve [(labels, valor), ...]
+
+    def __init__(self, name: str, description: str, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for labels, value in self.collect():
+            lines.append(f"{self.name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return lines
+
+
+registry = []
+
+
+def register(metric):
+    registry.append(metric)
+    return metric
+
+
+def counter(name: str, description: str):
+    return register(Counter(name, description))
+
+
+def histogram(name: str, description: str, buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, description, buckets))
+
+
+def gauge(name: str, description: str, collect):
+    return register(Gauge(name, description, collect))
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,119 @@
+import asyncio
+import sys
+from contextlib import contextmanager
+
+from sqlalchemy import inspect, text
+
+import models
+import api_keys
+import rollups
+from database import engine, async_engine, AsyncSessionLocal
+from leaderboard import TableLeaderboard
+
+# Criação e actualização do esquema da base de dados, como passo separado do arranque da API: importar main.py
+# não liga à base de dados, por isso os workers arrancam mais depressa e não falham no import se o Postgres
+# ainda não estiver disponível.
+# Corre uma vez por deploy, antes dos workers (initContainer no deployment.yaml, command no docker-compose.yml).
+#
+# Pode ser repetido sem efeitos extra e actualiza bases de dados criadas por versões anteriores:
+#   - cria as tabelas que faltam (create_all)
+#   - acrescenta às tabelas existentes as colunas que faltam (ex.: users.api_key_hash)
+#   - cria os índices que faltam (ex.: ix_users_total_points_id, ix_points_user_date_id, ix_quests_user_*)
+#   - converte as chaves de API em claro para hash (api_keys.py migrate)
+#   - preenche points_daily e user_ranks se foram criadas agora (rollups.py backfill, leaderboard.py rebuild)
+# Com várias réplicas do deployment cada pod corre o initContainer: em Postgres a migração é feita sob um advisory
+# lock, por isso as outras esperam que a primeira acabe e depois já não encontram nada para fazer.
+# Em Postgres criar um índice bloqueia as escritas nessa tabela enquanto é construído: numa base de dados grande
+# correr a actualização numa altura com pouco tráfego.
+#
+# Uso: python migrate.py create
+
+
+MIGRATION_LOCK = text("SELECT pg_advisory_lock(hashtext('pointsystem:migrate'))")
+MIGRATION_UNLOCK = text("SELECT pg_advisory_unlock(hashtext('pointsystem:migrate'))")
+
+
+# Só se acrescentam colunas que aceitam NULL: as linhas que já existem ficam sem valor
+def add_missing_columns(connection):
+    inspector = inspect(connection)
+    added = []
+    for table in models.Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable:
+                raise RuntimeError(f"Não é possível acrescentar {table.name}.{column.name}: é NOT NULL")
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+
+def create_missing_indexes(connection):
+    inspector = inspect(connection)
+    created = []
+    for table in models.Base.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=connection, checkfirst=True)
+                created.append(index.name)
+    return created
+
+
+# Só uma migração de cada vez (pg_advisory_lock numa ligação à parte, libertado no fim ou se o processo morrer)
+@contextmanager
+def migration_lock():
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(MIGRATION_LOCK)
+        try:
+            yield
+        finally:
+            connection.execute(MIGRATION_UNLOCK)
+
+
+async def migrate_data(new_tables):
+    try:
+        async with AsyncSessionLocal() as db:
+            hashed = await api_keys.migrate(db)
+        if "points_daily" in new_tables:
+            async with AsyncSessionLocal() as db:
+                await rollups.backfill(db)
+        if "user_ranks" in new_tables:
+            async with AsyncSessionLocal() as db:
+                await TableLeaderboard().rebuild(db)
+        return hashed
+    finally:
+        # As ligações ficam presas a este event loop; quem chamar create_schema() pode usar outro a seguir
+        await async_engine.dispose()
+
+
+# Devolve um resumo do que foi feito
+def create_schema():
+    with migration_lock():
+        with engine.begin() as connection:
+            inspector = inspect(connection)
+            new_tables = [table.name for table in models.Base.metadata.sorted_tables if not inspector.has_table(table.name)]
+            models.Base.metadata.create_all(bind=connection)
+            columns = add_missing_columns(connection)
+            indexes = create_missing_indexes(connection)
+        hashed = asyncio.run(migrate_data(new_tables))
+    return {"tables": new_tables, "columns": columns, "indexes": indexes, "hashed_api_keys": hashed}
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["create"]:
+        print("Uso: python migrate.py create")
+        sys.exit(1)
+
+    summary = create_schema()
+
+    print("✅ Esquema da base de dados actualizado com sucesso!")
+    print(f"   tabelas criadas: {', '.join(summary['tables']) or '-'}")
+    print(f"   colunas acrescentadas: {', '.join(summary['columns']) or '-'}")
+    print(f"   índices criados: {', '.join(summary['indexes']) or '-'}")
+    print(f"   chaves de API convertidas para hash: {summary['hashed_api_keys']}")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, func, Text, Boolean
+from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, func, Text, Boolean, Index, Date
 from sqlalchemy.orm import relationship
 from database import Base
 from datetime import datetime
@@ -10,15 +10,23 @@ class User(Base):
     name = Column(String, nullable=False)
     email = Column(String, unique=True, nullable=False)
     total_points = Column(Integer, default=0, nullable=False)
-    api_key = Column(String, unique=True, nullable=True)
+    api_key = Column(String, unique=True, nullable=True)  # Só em bases de dados antigas, ver migrate.py
+    api_key_hash = Column(String(64), unique=True, index=True, nullable=True)  # SHA-256 da chave de API
     current_badge_id = Column(Integer, ForeignKey("badges.id"), nullable=True)
 
 
     # Relação que relaciona com o historial de pontos
     points_history = relationship("Point", back_populates="user", cascade="all, delete-orphan")
-    current_badge = relationship("Badge", lazy="joined")
+    # Sem carregamento automático: quem precisar do badge pede-o na consulta (options(joinedload(User.current_badge))
+    # ou um join com Badge); aceder-lhe sem o ter carregado dá erro em vez de ir à base de dados
+    current_badge = relationship("Badge", lazy="raise")
     quests = relationship("Quest", back_populates="user")
 
+    # Índice usado pelas consultas paginadas do ranking (ORDER BY total_points DESC, id)
+    __table_args__ = (
+        Index("ix_users_total_points_id", total_points.desc(), id),
+    )
+
 class Point(Base):
     __tablename__ = 'points'
 
@@ -31,6 +39,13 @@ class Point(Base):
     # Relação que relaciona com o utilizador
     user = relationship("User", back_populates="points_history")
 
+    # Em Postgres a tabela pode ser particionada por mês (python archive.py partition); aí a chave primária
+    # passa a ser (id, change_date), mas o id continua único e o mapeamento não muda.
+    # Índice usado pela paginação do historial de um utilizador (ORDER BY change_date DESC, id DESC)
+    __table_args__ = (
+        Index("ix_points_user_date_id", user_id, change_date.desc(), id.desc()),
+    )
+
 class Badge(Base):
     __tablename__ = 'badges'
 
@@ -38,7 +53,7 @@ class Badge(Base):
     name = Column(String, unique=True, nullable=False)
     description = Column(String, nullable=True)
     image_filename = Column(String, nullable=False)
-    threshold = Column(Integer, nullable=True)  # Número de pontos necessários para ganhar um badge
+    threshold = Column(Integer, nullable=True, index=True)  # Número de pontos necessários para ganhar um badge
 
 class Quest(Base):
     __tablename__ = "quests"
@@ -52,5 +67,60 @@ class Quest(Base):
     user_id = Column(Integer, ForeignKey("users.id"))  # Relacionamento com o utilizador
     user = relationship("User", back_populates="quests")
 
+    # Listagens por utilizador (uma ou várias turmas) ordenadas por id, com ou sem filtro por estado
+    __table_args__ = (
+        Index("ix_quests_user_id", user_id, id),
+        Index("ix_quests_user_completed_id", user_id, completed, id),
+    )
+
+# Tabela materializada do ranking (usada quando LEADERBOARD_BACKEND=table).
+# É mantida incrementalmente pelo leaderboard.py a cada alteração de pontos e pode ser reconstruída do zero.
+class UserRank(Base):
+    __tablename__ = "user_ranks"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    total_points = Column(Integer, nullable=False)
+    rank = Column(Integer, nullable=False)  # Ranking de competição: utilizadores empatados partilham o mesmo rank
+
+    __table_args__ = (
+        Index("ix_user_ranks_points", total_points.desc(), user_id),
+        Index("ix_user_ranks_rank", rank),
+    )
+
+
+# Pontos de cada utilizador agregados por dia (soma dos points_change desse dia).
+# Mantida pelo ledger.py a cada linha escrita em points; usada pelos rankings por período (7 dias, 30 dias, semestre).
+# Pode ser reconstruída a partir do historial: python rollups.py backfill
+class DailyPoints(Base):
+    __tablename__ = "points_daily"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True)
+    points = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index("ix_points_daily_day_user", day, user_id),
+    )
+
+
+# Resumo mensal do historial arquivado (python archive.py archive): uma linha por utilizador e por mês
+# com a soma dos pontos e o número de alterações que foram compactadas.
+class PointArchive(Base):
+    __tablename__ = "points_archive"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    month = Column(TIMESTAMP, primary_key=True)  # Início do mês
+    points_change = Column(Integer, nullable=False)
+    entries = Column(Integer, nullable=False)
+
 
+# Respostas guardadas por Idempotency-Key (ver idempotency.py): um pedido repetido com a mesma chave
+# recebe a resposta do primeiro em vez de ser executado outra vez.
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
 
+    key = Column(String(255), primary_key=True)
+    request = Column(String, nullable=False)  # Método e caminho do pedido que usou a chave
+    status_code = Column(Integer, nullable=True)  # NULL enquanto o primeiro pedido não termina
+    response = Column(Text, nullable=True)
+    created_at = Column(TIMESTAMP, server_default=func.now(), nullable=False)
@@ -0,0 +1,183 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+from fastapi import Request
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import invalidation
+import metrics
+from database import AsyncSessionLocal, replica_engines
+
+# Encaminhamento das leituras para réplicas (DATABASE_REPLICA_URLS, ver database.py).
+#
+# Os endpoints GET pesados (ranking, leaderboards, historial, badges, quests) usam get_read_db em vez de get_db:
+# cada pedido vai para a réplica saudável seguinte (round-robin). Sem réplicas, ou sem nenhuma saudável,
+# tudo vai para o primário. As escritas usam sempre get_db (primário).
+#
+# Read-your-writes: depois de uma escrita bem sucedida de um utilizador, as leituras desse utilizador vão para o
+# primário durante READ_YOUR_WRITES_SECONDS, para não ver dados anteriores à sua própria escrita por causa do
+# atraso da réplica. O utilizador de um pedido é o user_id do caminho ou da query, ou o header X-User-Id.
+# Uma escrita sem utilizador conhecido (ex.: atribuição em massa) manda todas as leituras para o primário.
+# A janela é aberta no commit da sessão de get_db (note_writes_on_commit), antes de o endpoint incrementar as
+# versões da cache de respostas, por isso uma leitura que já veja a versão nova já vê também a janela.
+#
+# As respostas que ficam na cache partilhada (response_cache.py) são calculadas sempre no primário (shared=True):
+# uma réplica atrasada podia devolver dados anteriores a uma escrita cuja versão o pedido já leu, e essa resposta
+# ficava guardada com a versão nova até à escrita seguinte. Só as falhas de cache vão à base de dados, por isso o
+# custo no primário é no máximo uma consulta por versão. Sem cache (RESPONSE_CACHE_BACKEND=none) usam as réplicas.
+#
+# Uma tarefa em fundo testa as réplicas a cada REPLICA_HEALTH_INTERVAL segundos: uma réplica que não responda
+# ou (em Postgres) esteja mais de REPLICA_MAX_LAG segundos atrasada deixa de receber leituras até recuperar.
+# As escritas são anunciadas aos outros workers pelo canal de invalidação (invalidation.py), para a janela valer
+# em qualquer processo que receba a leitura seguinte.
+
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "10"))
+
+# Atraso da réplica em segundos (0 se já aplicou tudo o que recebeu, ou se não é uma réplica)
+REPLICA_LAG = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+reads = metrics.counter("db_reads_total", "Pedidos de leitura por destino (primary ou replicaN)")
+
+
+class Replica:
+
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.session = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+        self.healthy = True
+        self.lag = 0.0
+
+    async def lag_seconds(self):
+        async with self.engine.connect() as connection:
+            if self.engine.dialect.name == "postgresql":
+                return float(await connection.scalar(REPLICA_LAG) or 0)
+            await connection.execute(text("SELECT 1"))
+            return 0.0
+
+    async def check(self):
+        try:
+            self.lag = await asyncio.wait_for(self.lag_seconds(), REPLICA_HEALTH_INTERVAL)
+            self.healthy = self.lag <= REPLICA_MAX_LAG
+        except Exception:
+            self.healthy = False
+
+
+class ReplicaRouter:
+
+    def __init__(self, engines):
+        self.replicas = [Replica(f"replica{i}", engine) for i, engine in enumerate(engines)]
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        self._writes = {}  # user_id -> fim da janela read-your-writes desse utilizador
+        self._everyone_until = 0.0  # fim da janela de uma escrita sem utilizador conhecido
+        self._task = None
+
+    def note_write(self, user_id=None, broadcast: bool = True):
+        if broadcast and self.replicas:
+            invalidation.publish("write", user_id)
+        until = time.monotonic() + READ_YOUR_WRITES_SECONDS
+        with self._lock:
+            if user_id is None:
+                self._everyone_until = until
+                return
+            self._writes[user_id] = until
+            if len(self._writes) > 10000:
+                now = time.monotonic()
+                self._writes = {user: end for user, end in self._writes.items() if end > now}
+
+    def needs_primary(self, user_id=None, shared: bool = False):
+        if shared:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if self._everyone_until > now:
+                return True
+            return user_id is not None and self._writes.get(user_id, 0) > now
+
+    def choose(self):
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        return healthy[next(self._next) % len(healthy)]
+
+    def session(self, user_id=None, shared: bool = False):
+        replica = None if self.needs_primary(user_id, shared) else self.choose()
+        if replica is None:
+            reads.inc(target="primary")
+            return AsyncSessionLocal()
+        reads.inc(target=replica.name)
+        return replica.session()
+
+    async def check_all(self):
+        await asyncio.gather(*(replica.check() for replica in self.replicas))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(REPLICA_HEALTH_INTERVAL)
+            await self.check_all()
+
+    async def start(self):
+        if self.replicas and self._task is None:
+            await self.check_all()
+            self._task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return [{"name": replica.name, "healthy": replica.healthy, "lag_seconds": replica.lag} for replica in self.replicas]
+
+
+router = ReplicaRouter(replica_engines)
+
+
+# A sessão passa a abrir a janela read-your-writes de user_id em cada commit bem sucedido
+def note_writes_on_commit(db, user_id):
+    db.info["write_user"] = user_id
+
+
+@event.listens_for(Session, "after_commit")
+def _note_committed_write(session):
+    if "write_user" in session.info:
+        router.note_write(session.info["write_user"])
+
+
+def note_remote_writes(user_ids):
+    for user_id in user_ids:
+        router.note_write(user_id, broadcast=False)
+
+
+if router.replicas:
+    invalidation.subscribe("write", note_remote_writes)
+    invalidation.subscribe("resync", lambda _: router.note_write(None, broadcast=False))
+
+metrics.gauge(
+    "db_replica_healthy", "1 se a réplica está a receber leituras",
+    lambda: [({"replica": replica.name}, int(replica.healthy)) for replica in router.replicas]
+)
+metrics.gauge(
+    "db_replica_lag_seconds", "Atraso da réplica na última verificação",
+    lambda: [({"replica": replica.name}, replica.lag) for replica in router.replicas]
+)
+
+
+# Utilizador a quem o pedido diz respeito: user_id no caminho ou na query, senão o header X-User-Id
+def request_user(request: Request):
+    value = request.path_params.get("user_id") or request.query_params.get("user_id") or request.headers.get("x-user-id")
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
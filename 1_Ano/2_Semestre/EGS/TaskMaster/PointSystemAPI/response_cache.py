@@ -0,0 +1,202 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Request, Response
+
+import invalidation
+from serialization import timed_dumps, FastJSONResponse
+
+# Cache de respostas para os endpoints de leitura que as apps consultam periodicamente
+# (/v1/users/, /v1/badges, /v1/quests/user/{id}).
+#
+# Cada grupo de dados ("users", "badges", "quests:<user_id>") tem um contador de versão que os endpoints
+# de escrita incrementam depois do commit. A ETag de uma resposta é derivada do pedido e da versão, por isso:
+#   - If-None-Match igual à ETag actual -> 304 sem ir à base de dados (custa só ler o contador)
+#   - resposta já serializada para esta versão -> devolvida da cache
+#   - senão -> executa o endpoint, guarda o corpo e devolve-o com a ETag
+# Quando a versão muda, as respostas antigas deixam de ser usadas (e saem por LRU / TTL).
+#
+# Backends, escolhidos pela variável de ambiente RESPONSE_CACHE_BACKEND:
+#   memory -> dicionários no processo (por omissão). Com vários workers cada um tem as suas versões, mantidas
+#             a par pelo canal de invalidação (invalidation.py); as ETags diferem entre processos, por isso
+#             um cliente que mude de processo recebe 200 em vez de 304 uma vez
+#   redis  -> Redis em REDIS_URL, partilhado entre processos (requer o pacote redis)
+#   none   -> sem cache, os endpoints respondem sempre da base de dados
+
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+
+# As versões começam no relógio actual (ns) e não em 0, para uma ETag de antes de um reinício
+# (ou de a Redis ter sido limpa) nunca coincidir com uma nova.
+def initial_version():
+    return time.time_ns()
+
+
+class MemoryBackend:
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._bodies = OrderedDict()
+
+    async def version(self, scope: str):
+        with self._lock:
+            return self._versions.setdefault(scope, initial_version())
+
+    async def bump(self, *scopes: str):
+        with self._lock:
+            for scope in scopes:
+                self._versions[scope] = self._versions.get(scope, initial_version()) + 1
+
+    async def bump_all(self):
+        with self._lock:
+            for scope in self._versions:
+                self._versions[scope] += 1
+
+    async def get(self, key: str):
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+            return body
+
+    async def set(self, key: str, body: bytes):
+        with self._lock:
+            self._bodies[key] = body
+            self._bodies.move_to_end(key)
+            while len(self._bodies) > self.max_size:
+                self._bodies.popitem(last=False)
+
+
+class RedisBackend:
+    # client é um redis.asyncio.Redis (ou um fakeredis.aioredis.FakeRedis nos testes)
+
+    def __init__(self, client, ttl: int = RESPONSE_CACHE_TTL, prefix: str = "pointsystem:cache:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def version(self, scope: str):
+        key = self.prefix + "version:" + scope
+        version = await self.client.get(key)
+        if version is None:
+            await self.client.set(key, initial_version(), nx=True)
+            version = await self.client.get(key)
+        return int(version)
+
+    async def bump(self, *scopes: str):
+        async with self.client.pipeline(transaction=False) as pipe:
+            for scope in scopes:
+                key = self.prefix + "version:" + scope
+                pipe.set(key, initial_version(), nx=True)
+                pipe.incr(key)
+            await pipe.execute()
+
+    async def get(self, key: str):
+        return await self.client.get(self.prefix + "body:" + key)
+
+    async def set(self, key: str, body: bytes):
+        await self.client.set(self.prefix + "body:" + key, body, ex=self.ttl)
+
+
+class NoCache:
+
+    async def version(self, scope: str):
+        return None
+
+    async def bump(self, *scopes: str):
+        pass
+
+    async def get(self, key: str):
+        return None
+
+    async def set(self, key: str, body: bytes):
+        pass
+
+
+def make_backend(name: str):
+    if name == "memory":
+        return MemoryBackend(RESPONSE_CACHE_SIZE)
+    if name == "redis":
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis requer o pacote redis (pip install redis)")
+        return RedisBackend(redis.asyncio.Redis.from_url(REDIS_URL), RESPONSE_CACHE_TTL)
+    if name == "none":
+        return NoCache()
+    raise RuntimeError(f"RESPONSE_CACHE_BACKEND inválido: {name}")
+
+
+backend = make_backend(RESPONSE_CACHE_BACKEND)
+
+
+def set_backend(new_backend):
+    # Permite trocar o backend (ex.: RedisBackend com fakeredis nos testes)
+    global backend
+    backend = new_backend
+
+
+# Com a cache ligada as respostas dos endpoints com cached_response ficam partilhadas (ver replicas.py)
+def enabled():
+    return not isinstance(backend, NoCache)
+
+
+# Chamado pelos endpoints de escrita depois do commit
+async def bump(*scopes: str):
+    await backend.bump(*scopes)
+    # Na Redis as versões já são partilhadas; em memória os outros processos têm que as incrementar também
+    if isinstance(backend, MemoryBackend):
+        invalidation.publish("cache", list(scopes))
+
+
+async def bump_remote(items):
+    if isinstance(backend, MemoryBackend):
+        await backend.bump(*{scope for scopes in items for scope in scopes})
+
+
+async def bump_everything(_):
+    if isinstance(backend, MemoryBackend):
+        await backend.bump_all()
+
+
+invalidation.subscribe("cache", bump_remote)
+invalidation.subscribe("resync", bump_everything)
+
+
+def etag_matches(if_none_match: str, etag: str):
+    if if_none_match.strip() == "*":
+        return True
+    # Para If-None-Match a comparação é fraca: W/"x" e "x" são a mesma ETag
+    candidates = [tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+# Responde a partir da cache se possível; senão chama build() (que devolve os dados a serializar) e guarda o resultado
+async def cached_response(request: Request, scope: str, build):
+    version = await backend.version(scope)
+    if version is None:
+        return FastJSONResponse(content=await build())
+
+    request_key = request.url.path + "?" + "&".join(sorted(f"{k}={v}" for k, v in request.query_params.multi_items()))
+    key = f"{scope}:{version}:{request_key}"
+    etag = '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    body = await backend.get(key)
+    if body is None:
+        body = timed_dumps(await build())
+        await backend.set(key, body)
+
+    return Response(content=body, media_type="application/json", headers=headers)
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import sys
+from datetime import date, timedelta
+
+from sqlalchemy import select, delete, insert, func, literal, column, bindparam, cast, Integer
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import AsyncSessionLocal
+from models import User, Point, Badge, DailyPoints
+
+# Rankings por período (?window=7d|30d|term) calculados a partir da tabela points_daily,
+# que tem uma linha por utilizador e por dia em vez de uma por alteração de pontos.
+# O custo depende só do número de utilizadores activos no período, não do tamanho do historial.
+#
+# Os dias são os do relógio da base de dados (CURRENT_DATE), os mesmos de points.change_date.
+# O início do semestre vem de TERM_START (AAAA-MM-DD); sem ele usa-se 1 de Fevereiro ou 1 de Setembro.
+#
+# Para reconstruir a tabela a partir do historial: python rollups.py backfill
+
+TERM_START = os.getenv("TERM_START")
+
+WINDOWS = ("7d", "30d", "term")
+
+
+def term_start(today: date) -> date:
+    if TERM_START:
+        return date.fromisoformat(TERM_START)
+    if 2 <= today.month <= 8:
+        return date(today.year, 2, 1)
+    return date(today.year if today.month >= 9 else today.year - 1, 9, 1)
+
+
+def window_start(window: str, today: date) -> date:
+    if window == "7d":
+        return today - timedelta(days=6)
+    if window == "30d":
+        return today - timedelta(days=29)
+    return term_start(today)
+
+
+def upsert(db: AsyncSession):
+    if db.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(DailyPoints)
+    return sqlite.insert(DailyPoints)
+
+
+def add_on_conflict(statement):
+    # Se o utilizador já tem linha nesse dia, soma
+    return statement.on_conflict_do_update(
+        index_elements=[DailyPoints.user_id, DailyPoints.day],
+        set_={"points": DailyPoints.points + statement.excluded.points},
+    )
+
+
+# Soma as alterações de hoje à tabela de agregados: deltas é {user_id: soma dos points_change}.
+# Corre na transação da escrita em points, por isso as duas ficam sempre coerentes.
+async def add_to_rollup(db: AsyncSession, deltas):
+    if not deltas:
+        return
+
+    if db.get_bind().dialect.name == "postgresql" and len(deltas) > 1:
+        # INSERT INTO points_daily SELECT d.user_id, CURRENT_DATE, d.points FROM unnest(:user_ids, :points) AS d ...
+        d = func.unnest(
+            literal(list(deltas.keys()), ARRAY(Integer)),
+            literal(list(deltas.values()), ARRAY(Integer)),
+        ).table_valued(column("user_id", Integer), column("points", Integer)).render_derived(name="d")
+        statement = upsert(db).from_select(
+            ["user_id", "day", "points"],
+            select(d.c.user_id, func.current_date(), d.c.points),
+        )
+        await db.execute(add_on_conflict(statement))
+        return
+
+    statement = upsert(db).values(user_id=bindparam("uid"), day=func.current_date(), points=bindparam("delta"))
+    await db.execute(
+        add_on_conflict(statement),
+        [{"uid": user_id, "delta": points} for user_id, points in deltas.items()],
+    )
+
+
+# Ranking do período: [(rank, user_id, name, email, badge_name, points), ...] ordenado, com no máximo limit linhas
+async def window_ranking(db: AsyncSession, window: str, limit: int):
+    # O dia de hoje vem da base de dados, o mesmo relógio que preenche points_daily.day
+    today = (await db.execute(select(func.current_date()))).scalar_one()
+    since = window_start(window, today)
+    totals = (
+        select(
+            DailyPoints.user_id,
+            func.sum(DailyPoints.points).label("points"),
+        )
+        .where(DailyPoints.day >= since)
+        .group_by(DailyPoints.user_id)
+        .subquery("totals")
+    )
+    rows = (await db.execute(
+        select(
+            func.rank().over(order_by=totals.c.points.desc()).label("rank"),
+            User.id,
+            User.name,
+            User.email,
+            Badge.name.label("badge_name"),
+            totals.c.points,
+        )
+        .join(User, User.id == totals.c.user_id)
+        .join(Badge, User.current_badge_id == Badge.id, isouter=True)
+        .order_by(totals.c.points.desc(), User.id)
+        .limit(limit)
+    )).all()
+    return since, rows
+
+
+# Reconstrói points_daily a partir da tabela points
+async def backfill(db: AsyncSession):
+    if db.get_bind().dialect.name == "sqlite":
+        day = func.date(Point.change_date)
+    else:
+        day = cast(Point.change_date, DailyPoints.day.type)
+    await db.execute(delete(DailyPoints))
+    await db.execute(
+        insert(DailyPoints).from_select(
+            ["user_id", "day", "points"],
+            select(Point.user_id, day, func.sum(Point.points_change))
+            .where(Point.change_date.is_not(None))
+            .group_by(Point.user_id, day),
+        )
+    )
+    await db.commit()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        print("Uso: python rollups.py backfill")
+        sys.exit(1)
+
+    async def run_backfill():
+        async with AsyncSessionLocal() as db:
+            await backfill(db)
+
+    asyncio.run(run_backfill())
+
+    print("✅ Tabela points_daily reconstruída com sucesso!")
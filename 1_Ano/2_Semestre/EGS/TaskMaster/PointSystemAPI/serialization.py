@@ -0,0 +1,57 @@
+import json
+import time
+from datetime import date, datetime
+from decimal import Decimal
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+import instrumentation
+
+# Serialização rápida das respostas grandes (ranking, historial, respostas em cache).
+# Os endpoints que devolvem um dict passam pelo jsonable_encoder do FastAPI, que percorre e copia cada valor
+# antes de o json.dumps o voltar a percorrer; com milhares de linhas é aí que vai a maior parte do CPU.
+# Aqui os dados (dicts/listas de tipos simples, construídos a partir de tuplos de colunas) são escritos
+# directamente em bytes com orjson, ou com o json da biblioteca padrão se o orjson não estiver instalado.
+# O resultado é o mesmo JSON que o JSONResponse produziria.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def default(value):
+    # Tipos que não são nativos do JSON, convertidos como o jsonable_encoder faria
+    if isinstance(value, BaseModel):
+        return value.model_dump(mode="json")
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Tipo não serializável em JSON: {type(value).__name__}")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        content, default=default, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+# dumps() com o tempo contado na serialização do pedido (Server-Timing e métricas, ver instrumentation.py)
+def timed_dumps(content) -> bytes:
+    start = time.perf_counter()
+    body = dumps(content)
+    instrumentation.add_serialize_time(time.perf_counter() - start)
+    return body
+
+
+# Devolver uma FastJSONResponse (em vez de um dict) evita o jsonable_encoder do FastAPI
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content) -> bytes:
+        return timed_dumps(content)
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+# Os módulos da API lêem DATABASE_URL no import; os testes usam uma base de dados SQLite temporária
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "tests.db"))
+
+# Adiciona o path da pasta PointSystemAPI para importar os módulos de lá
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -0,0 +1,167 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+from starlette.requests import Request
+
+import instrumentation
+import response_cache
+from response_cache import MemoryBackend, RedisBackend, etag_matches
+
+# Testes da cache de respostas com ETag por versão (response_cache.py), nos backends memory e redis (fakeredis).
+#
+# Uso: pip install -r requirements-dev.txt && python -m pytest tests
+
+
+def make_request(path="/v1/badges", query="", if_none_match=None):
+    headers = [(b"if-none-match", if_none_match.encode())] if if_none_match else []
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": path,
+        "query_string": query.encode(),
+        "headers": headers,
+    })
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    if request.param == "memory":
+        new_backend = MemoryBackend(100)
+    else:
+        new_backend = RedisBackend(fakeredis.aioredis.FakeRedis())
+    previous = response_cache.backend
+    response_cache.set_backend(new_backend)
+    yield new_backend
+    response_cache.set_backend(previous)
+
+
+def get(scope, data, **request_args):
+    # Faz um pedido a cached_response e devolve (resposta, quantas vezes o endpoint foi executado)
+    calls = []
+
+    async def build():
+        calls.append(1)
+        return data
+
+    response = asyncio.run(response_cache.cached_response(make_request(**request_args), scope, build))
+    return response, len(calls)
+
+
+def test_repeated_request_is_served_from_cache(backend):
+    first, built = get("badges", {"n": 1})
+    assert first.status_code == 200 and built == 1
+
+    second, built = get("badges", {"n": 2})
+    assert built == 0
+    assert second.body == first.body
+    assert second.headers["etag"] == first.headers["etag"]
+
+
+def test_bump_invalidates_the_cached_response(backend):
+    first, _ = get("badges", {"n": 1})
+    asyncio.run(response_cache.bump("badges"))
+
+    second, built = get("badges", {"n": 2})
+    assert built == 1
+    assert second.body == b'{"n":2}'
+    assert second.headers["etag"] != first.headers["etag"]
+
+
+def test_bump_only_invalidates_its_scope(backend):
+    users, _ = get("users", {"n": 1}, path="/v1/users/")
+    asyncio.run(response_cache.bump("badges"))
+
+    again, built = get("users", {"n": 2}, path="/v1/users/")
+    assert built == 0
+    assert again.headers["etag"] == users.headers["etag"]
+
+
+def test_query_parameters_are_part_of_the_key(backend):
+    get("users", {"page": 1}, path="/v1/users/", query="limit=10")
+
+    other, built = get("users", {"page": 2}, path="/v1/users/", query="limit=20")
+    assert built == 1
+    assert other.body == b'{"page":2}'
+
+
+def test_if_none_match_returns_304_without_building(backend):
+    first, _ = get("badges", {"n": 1})
+
+    response, built = get("badges", {"n": 1}, if_none_match=first.headers["etag"])
+    assert response.status_code == 304
+    assert built == 0
+    assert response.headers["etag"] == first.headers["etag"]
+
+
+def test_if_none_match_after_bump_returns_200(backend):
+    first, _ = get("badges", {"n": 1})
+    asyncio.run(response_cache.bump("badges"))
+
+    response, built = get("badges", {"n": 2}, if_none_match=first.headers["etag"])
+    assert response.status_code == 200
+    assert built == 1
+
+
+def test_if_none_match_weak_and_list_forms(backend):
+    first, _ = get("badges", {"n": 1})
+    etag = first.headers["etag"]
+
+    assert get("badges", {}, if_none_match="W/" + etag)[0].status_code == 304
+    assert get("badges", {}, if_none_match='"outra", ' + etag)[0].status_code == 304
+    assert get("badges", {}, if_none_match="*")[0].status_code == 304
+    assert get("badges", {}, if_none_match='"outra"')[0].status_code == 200
+
+
+def test_serialization_of_a_miss_counts_in_the_request_timing(backend):
+    stats = instrumentation.RequestStats()
+    token = instrumentation.current.set(stats)
+    try:
+        get("badges", [{"n": i} for i in range(1000)])
+    finally:
+        instrumentation.current.reset(token)
+    assert stats.serialize_time > 0
+
+
+def test_etag_matches():
+    assert etag_matches('"abc"', '"abc"')
+    assert etag_matches('W/"abc"', '"abc"')
+    assert etag_matches('"x", W/"abc" , "y"', '"abc"')
+    assert etag_matches(" * ", '"abc"')
+    assert not etag_matches('"abcd"', '"abc"')
+    assert not etag_matches('W/"x", "y"', '"abc"')
+
+
+def test_redis_versions_are_shared_between_processes():
+    # Dois processos com a mesma Redis: um bump num invalida a resposta guardada pelo outro
+    server = fakeredis.FakeServer()
+    first = RedisBackend(fakeredis.aioredis.FakeRedis(server=server))
+    second = RedisBackend(fakeredis.aioredis.FakeRedis(server=server))
+    previous = response_cache.backend
+    try:
+        response_cache.set_backend(first)
+        cached, _ = get("badges", {"n": 1})
+
+        response_cache.set_backend(second)
+        same, built = get("badges", {"n": 1})
+        assert built == 0 and same.headers["etag"] == cached.headers["etag"]
+        asyncio.run(response_cache.bump("badges"))
+
+        response_cache.set_backend(first)
+        fresh, built = get("badges", {"n": 2})
+        assert built == 1 and fresh.body == b'{"n":2}'
+    finally:
+        response_cache.set_backend(previous)
+
+
+def test_redis_bodies_expire_with_the_ttl():
+    client = fakeredis.aioredis.FakeRedis()
+    previous = response_cache.backend
+    try:
+        response_cache.set_backend(RedisBackend(client, ttl=30))
+        get("badges", {"n": 1})
+        keys = asyncio.run(client.keys("pointsystem:cache:body:*"))
+        assert len(keys) == 1
+        assert 0 < asyncio.run(client.ttl(keys[0])) <= 30
+    finally:
+        response_cache.set_backend(previous)